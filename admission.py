@@ -0,0 +1,107 @@
+# admission.py
+
+import math
+import random
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+
+class Backpressure(Exception):
+    # Answered as 429 (this rig is sending too often) or 503 (the server is
+    # busy) with a Retry-After and a suggested offset for the next send
+    def __init__(self, status_code: int, reason: str, retry_after: float, next_send_offset: float) -> None:
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+        self.next_send_offset = next_send_offset
+
+
+class Admission:
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        max_inflight: int,
+        spread: float,
+        overload_retry_after: float = 5,
+        max_buckets: int = 100000,
+        pending: Callable[[], int] = lambda: 0,
+        max_pending: int = 0,
+    ) -> None:
+        # rate is tokens per second per rig and burst the bucket size; one
+        # token per request, so retries and keyframe resends fit in the burst
+        self.rate = rate
+        self.burst = burst
+        self.max_inflight = max_inflight
+        self.spread = spread
+        self.overload_retry_after = overload_retry_after
+        self.max_buckets = max_buckets
+        # Heartbeats accepted but not yet committed; a request that only
+        # queues finishes in microseconds, so this is what builds up when
+        # the writers fall behind
+        self.pending = pending
+        self.max_pending = max_pending
+
+        self._lock = threading.Lock()
+        # rig_id -> (tokens, monotonic time they were counted)
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self.inflight = 0
+
+    def phase(self, rig_id: str) -> float:
+        # A fixed slot per rig within the spread window, so rigs told to back
+        # off together come back evenly spaced rather than in one spike
+        return (zlib.crc32(rig_id.encode()) % 1000) / 1000 * self.spread
+
+    def _refill(self, rig_id: str, now: float) -> float:
+        tokens, updated = self._buckets.get(rig_id, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def _prune(self, now: float) -> None:
+        # Full buckets carry no state, forget them
+        for rig_id in [rig_id for rig_id in self._buckets if self._refill(rig_id, now) >= self.burst]:
+            del self._buckets[rig_id]
+
+    def check_rate(self, rig_ids: Iterable[str]) -> None:
+        # All or nothing, so a rejected batch doesn't use up any tokens
+        now = time.monotonic()
+        with self._lock:
+            if len(self._buckets) > self.max_buckets:
+                self._prune(now)
+            rig_ids = set(rig_ids)
+            tokens = {rig_id: self._refill(rig_id, now) for rig_id in rig_ids}
+            short = [rig_id for rig_id, available in tokens.items() if available < 1]
+            if short:
+                wait = max((1 - tokens[rig_id]) / self.rate for rig_id in short)
+                raise Backpressure(429, "rate_limited", wait, wait)
+            for rig_id, available in tokens.items():
+                self._buckets[rig_id] = (available - 1, now)
+
+    def overloaded(self, rig_id: Optional[str] = None) -> Backpressure:
+        # Before the body is read there is no rig_id to take a slot from
+        offset = self.overload_retry_after
+        offset += self.phase(rig_id) if rig_id else random.uniform(0, self.spread)
+        return Backpressure(503, "overloaded", self.overload_retry_after, offset)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        # Global cap on heartbeat requests being decoded and queued at once,
+        # and on the work they leave behind for the writers
+        with self._lock:
+            if self.inflight >= self.max_inflight:
+                raise self.overloaded()
+            if self.max_pending and self.pending() >= self.max_pending:
+                raise self.overloaded()
+            self.inflight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.inflight -= 1
+
+
+def retry_after_header(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
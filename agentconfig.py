@@ -0,0 +1,146 @@
+# agentconfig.py
+
+import math
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Scope of the document every rig gets; per-rig documents override it
+FLEET = "*"
+
+MIN_INTERVAL_S = 5
+MAX_INTERVAL_S = 3600
+
+ADAPTIVE_DEFAULTS = {
+    "enabled": True,
+    # While a watched process runs or metrics move, and for hold_seconds after
+    "active_interval": 15,
+    # When nothing runs and the CPU is below idle_cpu
+    "idle_interval": 300,
+    "idle_cpu": 10,
+    # Percentage points of CPU or memory between heartbeats that count as change
+    "change_threshold": 20,
+    "hold_seconds": 300,
+}
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def _check_interval(name: str, value: Any, min_interval: float) -> None:
+    if not _is_number(value) or not min_interval <= value <= MAX_INTERVAL_S:
+        raise ValueError(f"{name} must be between {min_interval:g} and {MAX_INTERVAL_S} seconds")
+
+
+def validate_config(doc: Any, min_interval: float = MIN_INTERVAL_S) -> Dict[str, Any]:
+    # min_interval is raised by the server to what its per-rig rate limit
+    # lets through, so an accepted config never runs into 429s
+    if not isinstance(doc, dict):
+        raise ValueError("Config must be an object")
+    unknown = set(doc) - {"interval_seconds", "jitter_seconds", "process_names", "collectors", "metadata", "adaptive"}
+    if unknown:
+        raise ValueError(f"Unknown config keys: {', '.join(sorted(unknown))}")
+
+    if "interval_seconds" in doc:
+        _check_interval("interval_seconds", doc["interval_seconds"], min_interval)
+    if "jitter_seconds" in doc and (not _is_number(doc["jitter_seconds"]) or doc["jitter_seconds"] < 0):
+        raise ValueError("jitter_seconds must be a non-negative number")
+    if "process_names" in doc and (
+        not isinstance(doc["process_names"], list)
+        or not all(isinstance(name, str) for name in doc["process_names"])
+    ):
+        raise ValueError("process_names must be an array of strings")
+    if "collectors" in doc and (
+        not isinstance(doc["collectors"], dict)
+        or not all(isinstance(options, dict) for options in doc["collectors"].values())
+    ):
+        raise ValueError("collectors must map names to option objects")
+    if "metadata" in doc and not isinstance(doc["metadata"], dict):
+        raise ValueError("metadata must be an object")
+
+    adaptive = doc.get("adaptive", {})
+    if not isinstance(adaptive, dict):
+        raise ValueError("adaptive must be an object")
+    unknown = set(adaptive) - set(ADAPTIVE_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown adaptive keys: {', '.join(sorted(unknown))}")
+    for key, value in adaptive.items():
+        if key == "enabled":
+            if not isinstance(value, bool):
+                raise ValueError("adaptive.enabled must be a boolean")
+        elif key.endswith("_interval"):
+            _check_interval(f"adaptive.{key}", value, min_interval)
+        elif not _is_number(value) or value < 0:
+            raise ValueError(f"adaptive.{key} must be a non-negative number")
+    return doc
+
+
+class AgentConfigs:
+    # Versioned config documents for agents, a fleet-wide one and optional
+    # per-rig overrides. The effective version is "<fleet>.<rig>", so an
+    # agent can tell from one string whether either side changed.
+    def __init__(self, default_interval: float, adaptive: bool = True, min_interval: float = MIN_INTERVAL_S) -> None:
+        self.default_interval = default_interval
+        self.adaptive = adaptive
+        self.min_interval = min_interval
+
+        self._lock = threading.Lock()
+        # scope -> (version, document)
+        self._docs: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+        # rig_id -> (cpu, memory, active_until) from its last heartbeat
+        self._activity: Dict[str, Tuple[Optional[float], Optional[float], float]] = {}
+
+    def load(self, rows: List[Tuple[str, int, Dict[str, Any]]]) -> None:
+        with self._lock:
+            self._docs = {scope: (version, doc) for scope, version, doc in rows}
+
+    def set(self, scope: str, version: int, doc: Dict[str, Any]) -> None:
+        with self._lock:
+            self._docs[scope] = (version, doc)
+
+    def documents(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {scope: {"version": version, "config": doc} for scope, (version, doc) in self._docs.items()}
+
+    def effective(self, rig_id: str) -> Tuple[str, Dict[str, Any]]:
+        with self._lock:
+            fleet_version, fleet = self._docs.get(FLEET, (0, {}))
+            rig_version, override = self._docs.get(rig_id, (0, {}))
+        doc = {**fleet, **override}
+        if "adaptive" in fleet and "adaptive" in override:
+            doc["adaptive"] = {**fleet["adaptive"], **override["adaptive"]}
+        return f"{fleet_version}.{rig_version}", doc
+
+    def interval_for(self, rig_id: str, data: Dict[str, Any], running: bool) -> float:
+        # Never below min_interval, which documents stored before a rate
+        # limit change could still ask for
+        return max(self.min_interval, self._interval(rig_id, data, running))
+
+    def _interval(self, rig_id: str, data: Dict[str, Any], running: bool) -> float:
+        # Faster while a watched process runs or CPU/memory jump, slower
+        # when the rig sits idle, the configured interval otherwise
+        _, doc = self.effective(rig_id)
+        base = doc.get("interval_seconds", self.default_interval)
+        policy = {**ADAPTIVE_DEFAULTS, **doc.get("adaptive", {})}
+        if not self.adaptive or not policy["enabled"]:
+            return base
+
+        cpu = data.get("cpu_percent") if _is_number(data.get("cpu_percent")) else None
+        memory = data.get("memory_percent") if _is_number(data.get("memory_percent")) else None
+        now = time.monotonic()
+        with self._lock:
+            last_cpu, last_memory, active_until = self._activity.get(rig_id, (None, None, 0.0))
+            changing = any(
+                new is not None and old is not None and abs(new - old) >= policy["change_threshold"]
+                for new, old in ((cpu, last_cpu), (memory, last_memory))
+            )
+            if running or changing:
+                active_until = now + policy["hold_seconds"]
+            self._activity[rig_id] = (cpu, memory, active_until)
+
+        if now < active_until:
+            return min(base, policy["active_interval"])
+        if cpu is not None and cpu < policy["idle_cpu"]:
+            return max(base, policy["idle_interval"])
+        return base
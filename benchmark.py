@@ -0,0 +1,368 @@
+# benchmark.py
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import percentiles
+from shards import shard_paths
+
+API_KEY = "benchmark-key"
+SERVER_SCRIPT = Path(__file__).parent / "server.py"
+
+# Relative change against the baseline that counts as a regression
+DEFAULT_TOLERANCE = 0.25
+# Absolute increase in error rate that counts as a regression
+ERROR_RATE_TOLERANCE = 0.01
+
+PROCESS_NAMES = ["CANoe.exe", "Vector_CANoe.exe", "HILSoftware.exe", "TestRunner.exe"]
+
+
+class HttpConnection:
+    # Minimal keep-alive HTTP/1.1 client, so thousands of simulated agents
+    # don't pull in a client library or a thread each
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+    async def request(
+        self, method: str, path: str, body: bytes = b"", headers: Optional[Dict[str, str]] = None
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", f"Content-Length: {len(body)}"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        try:
+            await self._writer.drain()
+            status_line = await self._reader.readline()
+            if not status_line:
+                raise ConnectionError("Server closed the connection")
+            status = int(status_line.split()[1])
+
+            response_headers = {}
+            while True:
+                line = await self._reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode().partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+            content = await self._reader.readexactly(int(response_headers.get("content-length", 0)))
+        except Exception:
+            await self.close()
+            raise
+
+        if response_headers.get("connection") == "close":
+            await self.close()
+        return status, response_headers, content
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, kind: str, seconds: float, ok: bool) -> None:
+        self.latencies.setdefault(kind, []).append(seconds)
+        if not ok:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def summary(self, kind: str, duration: float) -> Dict[str, Any]:
+        latencies = self.latencies.get(kind, [])
+        errors = self.errors.get(kind, 0)
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "error_rate": round(errors / len(latencies), 4) if latencies else 0.0,
+            "throughput_per_s": round((len(latencies) - errors) / duration, 2),
+            "latency_ms": percentiles(latencies),
+        }
+
+
+def heartbeat_payload(rig_id: str, index: int) -> Dict[str, Any]:
+    # Shaped like Agent.collect_status in daemon mode
+    cpu = random.uniform(2, 95)
+    running = random.sample(PROCESS_NAMES, random.randint(0, 2))
+    now = datetime.now(timezone.utc)
+    return {
+        "rig_id": rig_id,
+        "timestamp": now.isoformat(),
+        **{name: "running" for name in running},
+        "processes": [
+            {
+                "name": name,
+                "pid": 1000 + i,
+                "cpu_percent": round(random.uniform(0, 50), 1),
+                "rss_mb": round(random.uniform(50, 900), 1),
+                "started": now.isoformat(),
+                "handles": random.randint(100, 2000),
+            }
+            for i, name in enumerate(running)
+        ],
+        "process_events": [],
+        "hostname": f"HIL-{index:05d}",
+        "ip_address": f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}",
+        "cpu_percent": round(cpu, 1),
+        "memory_percent": round(random.uniform(20, 90), 1),
+        "memory_used_gb": round(random.uniform(4, 28), 2),
+        "memory_total_gb": 32.0,
+        "disk_percent": round(random.uniform(30, 80), 1),
+        "disk_free_gb": round(random.uniform(50, 400), 2),
+        "uptime_hours": round(random.uniform(1, 900), 1),
+        "interval_stats": {
+            metric: {"min": 1.0, "avg": round(cpu, 1), "p95": round(min(100, cpu * 1.3), 1), "max": 100.0, "samples": 60}
+            for metric in ("cpu_percent", "memory_percent", "disk_percent")
+        },
+        "location": f"Lab {'ABCD'[index % 4]} - Building {index % 7}",
+        "rack": f"R{index % 40:02d}",
+        "capabilities": ["CAN", "LIN", "Ethernet"][: 1 + index % 3],
+        "ecu_type": f"ECU_{index % 12}",
+        "contact": "hil-team@company.com",
+        "agent_version": "0.1",
+        "os": "Windows-11-10.0.22631-SP0",
+    }
+
+
+async def run_agent(
+    index: int, pool: asyncio.Queue, recorder: Recorder, interval: float, deadline: float
+) -> None:
+    rig_id = f"bench-{index:05d}"
+    # Random phase so agents don't all fire on the same tick
+    next_send = time.monotonic() + random.uniform(0, interval)
+    while True:
+        await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+        if time.monotonic() >= deadline:
+            return
+        body = json.dumps(heartbeat_payload(rig_id, index)).encode()
+        connection = await pool.get()
+        started = time.perf_counter()
+        try:
+            status, _, _ = await connection.request(
+                "POST",
+                "/api/heartbeat",
+                body,
+                {"Content-Type": "application/json", "Authorization": f"Bearer {API_KEY}"},
+            )
+            ok = status == 200
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            ok = False
+        finally:
+            pool.put_nowait(connection)
+        recorder.record("heartbeat", time.perf_counter() - started, ok)
+        next_send += interval
+
+
+async def run_reader(
+    connection: HttpConnection, agents: int, recorder: Recorder, rate: float, deadline: float
+) -> None:
+    # Dashboard-style polling: the inventory, then a single rig
+    etag = None
+    while time.monotonic() < deadline:
+        await asyncio.sleep(random.expovariate(rate))
+        if random.random() < 0.5:
+            kind, path = "list_rigs", "/api/rigs"
+            headers = {"If-None-Match": etag} if etag else {}
+        else:
+            kind, path, headers = "get_rig", f"/api/rigs/bench-{random.randrange(agents):05d}", {}
+
+        started = time.perf_counter()
+        try:
+            status, response_headers, _ = await connection.request("GET", path, headers=headers)
+            ok = status in (200, 304, 404)
+            if kind == "list_rigs" and status == 200:
+                etag = response_headers.get("etag")
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            ok = False
+        recorder.record(kind, time.perf_counter() - started, ok)
+
+
+async def fetch_json(host: str, port: int, path: str) -> Dict[str, Any]:
+    connection = HttpConnection(host, port)
+    try:
+        status, _, body = await connection.request("GET", path)
+        if status != 200:
+            raise ConnectionError(f"GET {path} returned {status}")
+        return json.loads(body)
+    finally:
+        await connection.close()
+
+
+async def wait_until_ready(host: str, port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await fetch_json(host, port, "/")
+            return
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Server did not start within {timeout}s")
+            await asyncio.sleep(0.2)
+
+
+async def run_load(args: argparse.Namespace, host: str, port: int) -> Dict[str, Any]:
+    recorder = Recorder()
+    pool: asyncio.Queue = asyncio.Queue()
+    connections = [HttpConnection(host, port) for _ in range(args.connections)]
+    for connection in connections:
+        pool.put_nowait(connection)
+    readers = [HttpConnection(host, port) for _ in range(args.readers)]
+
+    started = time.monotonic()
+    deadline = started + args.duration
+    tasks = [run_agent(i, pool, recorder, args.interval, deadline) for i in range(args.agents)]
+    tasks += [run_reader(reader, args.agents, recorder, args.read_rate, deadline) for reader in readers]
+    await asyncio.gather(*tasks)
+    duration = time.monotonic() - started
+
+    for connection in connections + readers:
+        await connection.close()
+
+    # Let the write-behind queue drain before reading commit statistics
+    await asyncio.sleep(1)
+    server_stats = await fetch_json(host, port, "/api/stats")
+    return {
+        "duration_s": round(duration, 2),
+        "heartbeats": recorder.summary("heartbeat", duration),
+        "reads": {kind: recorder.summary(kind, duration) for kind in ("list_rigs", "get_rig")},
+        "commit_ms": server_stats["ingest"]["commit_ms"],
+        "server": server_stats,
+    }
+
+
+def database_size(db_path: Path, shards: int) -> int:
+    return sum(
+        path.stat().st_size
+        for shard_path in shard_paths(db_path, shards)
+        for path in (shard_path, shard_path.with_name(shard_path.name + "-wal"))
+        if path.exists()
+    )
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    regressions = []
+    current, previous = results["heartbeats"], baseline["heartbeats"]
+    for percentile in ("p95", "p99"):
+        now, before = current["latency_ms"][percentile], previous["latency_ms"][percentile]
+        if now is not None and before and now > before * (1 + tolerance):
+            regressions.append(f"heartbeat {percentile} latency {before}ms -> {now}ms")
+    if current["throughput_per_s"] < previous["throughput_per_s"] * (1 - tolerance):
+        regressions.append(
+            f"heartbeat throughput {previous['throughput_per_s']}/s -> {current['throughput_per_s']}/s"
+        )
+    if current["error_rate"] > previous["error_rate"] + ERROR_RATE_TOLERANCE:
+        regressions.append(f"heartbeat error rate {previous['error_rate']} -> {current['error_rate']}")
+
+    now, before = results["commit_ms"]["p95"], baseline["commit_ms"]["p95"]
+    if now is not None and before and now > before * (1 + tolerance):
+        regressions.append(f"commit p95 {before}ms -> {now}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of agents against a local Vigilant server")
+    parser.add_argument("--agents", type=int, default=1000, help="Number of simulated rigs")
+    parser.add_argument("--interval", type=float, default=60, help="Seconds between heartbeats per rig")
+    parser.add_argument("--duration", type=float, default=120, help="Length of the run in seconds")
+    parser.add_argument("--connections", type=int, default=100, help="Keep-alive connections shared by the agents")
+    parser.add_argument("--readers", type=int, default=4, help="Concurrent dashboard readers")
+    parser.add_argument("--read-rate", type=float, default=2, help="Requests per second per reader")
+    parser.add_argument("--shards", type=int, default=1, help="DB_SHARDS for the server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", type=Path, default=Path("benchmark-results.json"))
+    parser.add_argument("--baseline", type=Path, help="Earlier results to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--keep", action="store_true", help="Keep the database and server log")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="vigilant-bench-"))
+    db_path = workdir / "vigilant.db"
+    env = {
+        **os.environ,
+        "API_KEY": API_KEY,
+        "PORT": str(args.port),
+        "DB_PATH": str(db_path),
+        "DB_SHARDS": str(args.shards),
+        "ARCHIVE_DIR": str(workdir / "archive"),
+        "RETENTION_DAYS": "0",
+        "HEARTBEAT_INTERVAL_S": str(int(args.interval)),
+        # Simulated agents send on schedule; keep the per-rig limit out of the way
+        "RIG_RATE_PER_MIN": str(2 * 60 / args.interval),
+    }
+    print(f"Starting server on port {args.port} with database {db_path}")
+    server = subprocess.Popen(
+        [sys.executable, str(SERVER_SCRIPT), "serve"],
+        env=env,
+        stdout=open(workdir / "server.log", "wb"),
+        stderr=subprocess.STDOUT,
+    )
+    try:
+        asyncio.run(wait_until_ready("127.0.0.1", args.port, 30))
+        size_before = database_size(db_path, args.shards)
+        print(
+            f"Simulating {args.agents} agents every {args.interval}s "
+            f"and {args.readers} readers for {args.duration}s"
+        )
+        results = asyncio.run(run_load(args, "127.0.0.1", args.port))
+    finally:
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    size_after = database_size(db_path, args.shards)
+    if args.keep:
+        print(f"Kept database and server log in {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    stored = results["server"]["ingest"]["written"]
+    results["db"] = {
+        "size_before_bytes": size_before,
+        "size_after_bytes": size_after,
+        "growth_bytes": size_after - size_before,
+        "bytes_per_heartbeat": round((size_after - size_before) / stored, 1) if stored else None,
+    }
+    results["config"] = {
+        key: getattr(args, key)
+        for key in ("agents", "interval", "duration", "connections", "readers", "read_rate", "shards")
+    }
+
+    args.output.write_text(json.dumps(results, indent=2))
+    heartbeats = results["heartbeats"]
+    print(
+        f"Heartbeats: {heartbeats['requests']} sent, {heartbeats['throughput_per_s']}/s, "
+        f"error rate {heartbeats['error_rate']}, latency {heartbeats['latency_ms']}"
+    )
+    print(f"Commit: {results['commit_ms']}")
+    print(f"Database grew {results['db']['growth_bytes']} bytes")
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# delta.py
+
+import threading
+from typing import Any, Dict, Tuple
+
+
+class KeyframeRequired(Exception):
+    pass
+
+
+class DeltaDecoder:
+    # Rebuilds full heartbeats from delta frames. A frame is
+    # {"rig_id", "seq", "base", "set", "unset"}; base is None for a keyframe,
+    # otherwise the seq of the state the agent last saw acknowledged.
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._states: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def apply(self, frame: Dict[str, Any]) -> Dict[str, Any]:
+        rig_id = frame.get("rig_id")
+        seq = frame.get("seq")
+        base = frame.get("base")
+        changed = frame.get("set") or {}
+        removed = frame.get("unset") or []
+        if not isinstance(rig_id, str) or not rig_id:
+            raise ValueError("Missing rig_id")
+        if not isinstance(seq, int) or (base is not None and not isinstance(base, int)):
+            raise ValueError("seq and base must be integers")
+        if not isinstance(changed, dict) or not isinstance(removed, list):
+            raise ValueError("set must be an object and unset an array")
+
+        with self._lock:
+            if base is None:
+                state = dict(changed)
+            else:
+                current = self._states.get(rig_id)
+                # Unknown after a restart, or the agent missed an ack
+                if current is None or current[0] != base:
+                    raise KeyframeRequired(rig_id)
+                state = {**current[1], **changed}
+                for key in removed:
+                    state.pop(key, None)
+
+            state["rig_id"] = rig_id
+            self._states[rig_id] = (seq, state)
+        return state
+
+    def forget(self, rig_id: str) -> None:
+        with self._lock:
+            self._states.pop(rig_id, None)
@@ -0,0 +1,299 @@
+# fleet.py
+
+import math
+import operator
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from itertools import accumulate, compress
+from typing import Any, Dict, List, Optional, Tuple
+
+from state import running_processes
+from storage import Heartbeat
+
+GROUP_FIELDS = ("location", "rack", "ecu_type")
+
+# Percent metrics, so a fixed 0-100 histogram is an exact enough sketch
+WINDOW_METRICS = ("cpu_percent", "memory_percent", "disk_percent")
+
+SLOT_MS = 60 * 1000
+# One hour of one-minute slots
+SLOTS = 60
+BIN_WIDTH = 2
+BINS = 100 // BIN_WIDTH + 1
+EMPTY_BINS = array("I", bytes(4 * BINS))
+
+# (field, value), ("*", None) for the whole fleet
+GroupKey = Tuple[str, Optional[str]]
+
+# (status, busy, capabilities, groups, running, metrics)
+RigEntry = Tuple[str, bool, Tuple[str, ...], Tuple[GroupKey, ...], Tuple[str, ...], Dict[str, float]]
+
+FLEET: GroupKey = ("*", None)
+
+EMPTY_SUMMARY = {"samples": 0, "busy_ratio": None, **dict.fromkeys(WINDOW_METRICS)}
+
+
+def _group_value(value: Any) -> Optional[str]:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (str, int, float)):
+        return str(value)
+    return None
+
+
+def _percent(value: Any) -> Optional[float]:
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        return None
+    # Out-of-range readings would skew the sums and fall outside the bins
+    return min(100.0, max(0.0, float(value)))
+
+
+def _add(counter: Counter, key: Any, sign: int) -> None:
+    counter[key] += sign
+    if not counter[key]:
+        del counter[key]
+
+
+def _quantile(cumulative: List[int], count: float, q: float) -> float:
+    # Midpoint of the bin holding the q-th sample
+    index = bisect_left(cumulative, q * count)
+    return min(100.0, index * BIN_WIDTH + BIN_WIDTH / 2)
+
+
+class SlidingWindow:
+    # One-minute slots in fixed arrays, reused as the ring wraps around. Each
+    # slot holds the sample and busy counts and, per metric, a sum, a count
+    # and a histogram. Running totals over the whole ring are kept alongside
+    # and adjusted as slots are filled and expire, so an hour-long query
+    # costs the same however many heartbeats went into it.
+    def __init__(self) -> None:
+        self.minutes = array("q", [-1]) * SLOTS
+        self.samples = array("d", bytes(8 * SLOTS))
+        self.busy = array("d", bytes(8 * SLOTS))
+        self.sums = {metric: array("d", bytes(8 * SLOTS)) for metric in WINDOW_METRICS}
+        self.counts = {metric: array("d", bytes(8 * SLOTS)) for metric in WINDOW_METRICS}
+        self.bins = {metric: array("I", bytes(4 * SLOTS * BINS)) for metric in WINDOW_METRICS}
+
+        self.total_samples = 0.0
+        self.total_busy = 0.0
+        self.total_sums = dict.fromkeys(WINDOW_METRICS, 0.0)
+        self.total_counts = dict.fromkeys(WINDOW_METRICS, 0.0)
+        self.total_bins = {metric: array("I", EMPTY_BINS) for metric in WINDOW_METRICS}
+
+    def _clear(self, slot: int) -> None:
+        self.total_samples -= self.samples[slot]
+        self.total_busy -= self.busy[slot]
+        self.samples[slot] = 0
+        self.busy[slot] = 0
+        for metric in WINDOW_METRICS:
+            self.total_sums[metric] -= self.sums[metric][slot]
+            self.total_counts[metric] -= self.counts[metric][slot]
+            self.sums[metric][slot] = 0
+            self.counts[metric][slot] = 0
+            row = self.bins[metric][slot * BINS:(slot + 1) * BINS]
+            self.total_bins[metric] = array("I", map(operator.sub, self.total_bins[metric], row))
+            self.bins[metric][slot * BINS:(slot + 1) * BINS] = EMPTY_BINS
+
+    def expire(self, current: int) -> None:
+        for slot, minute in enumerate(self.minutes):
+            if minute != -1 and minute <= current - SLOTS:
+                self._clear(slot)
+                self.minutes[slot] = -1
+
+    def add(self, minute: int, values: Dict[str, float], busy: bool) -> None:
+        slot = minute % SLOTS
+        if self.minutes[slot] > minute:
+            # Older than anything the ring still holds
+            return
+        if self.minutes[slot] != minute:
+            self._clear(slot)
+            self.minutes[slot] = minute
+
+        self.samples[slot] += 1
+        self.total_samples += 1
+        if busy:
+            self.busy[slot] += 1
+            self.total_busy += 1
+        for metric, value in values.items():
+            index = min(BINS - 1, int(value // BIN_WIDTH))
+            self.sums[metric][slot] += value
+            self.counts[metric][slot] += 1
+            self.bins[metric][slot * BINS + index] += 1
+            self.total_sums[metric] += value
+            self.total_counts[metric] += 1
+            self.total_bins[metric][index] += 1
+
+    def summarize(self, current: int, minutes: int) -> Dict[str, Any]:
+        self.expire(current)
+        if minutes >= SLOTS:
+            samples, busy = self.total_samples, self.total_busy
+            sums, counts, bins = self.total_sums, self.total_counts, self.total_bins
+        else:
+            # Shorter windows add up only the slots they cover
+            mask = [current - minutes < minute <= current for minute in self.minutes]
+            slots = list(compress(range(SLOTS), mask))
+            samples = sum(compress(self.samples, mask))
+            busy = sum(compress(self.busy, mask))
+            sums = {metric: sum(compress(self.sums[metric], mask)) for metric in WINDOW_METRICS}
+            counts = {metric: sum(compress(self.counts[metric], mask)) for metric in WINDOW_METRICS}
+            bins = {
+                metric: list(map(sum, zip(EMPTY_BINS, *(
+                    self.bins[metric][slot * BINS:(slot + 1) * BINS] for slot in slots
+                ))))
+                for metric in WINDOW_METRICS
+            }
+
+        result: Dict[str, Any] = {
+            "samples": int(samples),
+            "busy_ratio": round(busy / samples, 3) if samples else None,
+        }
+        for metric in WINDOW_METRICS:
+            count = counts[metric]
+            if not count:
+                result[metric] = None
+                continue
+            cumulative = list(accumulate(bins[metric]))
+            result[metric] = {
+                "avg": round(sums[metric] / count, 1),
+                "p50": _quantile(cumulative, count, 0.5),
+                "p95": _quantile(cumulative, count, 0.95),
+                "max": _quantile(cumulative, count, 1.0),
+            }
+        return result
+
+
+class FleetAggregates:
+    # Counters over every rig's current state plus sliding windows of recent
+    # heartbeats per group, both kept up to date by ingest so reads never
+    # touch the database
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._rigs: Dict[str, RigEntry] = {}
+        self._latest_ts: Dict[str, int] = {}
+        # (field, value) -> rigs/online/busy/free counts, where field is a
+        # group field, "capability", or "*" for the whole fleet
+        self._counts: Dict[GroupKey, Counter] = {}
+        self._status: Counter = Counter()
+        self._running: Counter = Counter()
+        # Current metric totals over online rigs
+        self._metric_sums: Dict[str, float] = dict.fromkeys(WINDOW_METRICS, 0.0)
+        self._metric_counts: Counter = Counter()
+        self._windows: Dict[GroupKey, SlidingWindow] = {}
+
+    def _count(self, entry: RigEntry, sign: int) -> None:
+        status, busy, capabilities, groups, running, _ = entry
+        _add(self._status, status, sign)
+        for name in running:
+            _add(self._running, name, sign)
+        flags = ["rigs"]
+        if status == "online":
+            flags.append("online")
+            flags.append("busy" if busy else "free")
+        for key in (FLEET, *(("capability", capability) for capability in capabilities), *groups):
+            counts = self._counts.setdefault(key, Counter())
+            for flag in flags:
+                counts[flag] += sign
+            if not counts["rigs"]:
+                del self._counts[key]
+        if status == "online":
+            for metric, value in entry[5].items():
+                self._metric_sums[metric] += sign * value
+                self._metric_counts[metric] += sign
+
+    def _set(self, rig_id: str, entry: RigEntry) -> None:
+        old = self._rigs.get(rig_id)
+        if old is not None:
+            self._count(old, -1)
+        self._rigs[rig_id] = entry
+        self._count(entry, 1)
+
+    def _entry(self, status: str, data: Dict[str, Any]) -> RigEntry:
+        capabilities = data.get("capabilities")
+        if not isinstance(capabilities, list):
+            capabilities = []
+        running = tuple(running_processes(data))
+        metrics = {metric: value for metric in WINDOW_METRICS if (value := _percent(data.get(metric))) is not None}
+        return (
+            status,
+            bool(running),
+            tuple(sorted({value for value in map(_group_value, capabilities) if value is not None})),
+            tuple((field, _group_value(data.get(field))) for field in GROUP_FIELDS),
+            running,
+            metrics,
+        )
+
+    def load(self, snapshot: List[Dict[str, Any]]) -> None:
+        # Windows start empty; only current state is known after a restart
+        with self._lock:
+            for item in snapshot:
+                rig, latest = item["rig"], item["latest_heartbeat"]
+                self._set(rig["rig_id"], self._entry(rig["status"] or "offline", latest["data"] if latest else {}))
+                if latest:
+                    self._latest_ts[rig["rig_id"]] = latest["ts"]
+
+    def apply(self, items: List[Heartbeat]) -> None:
+        now = int(time.time() * 1000)
+        with self._lock:
+            for rig_id, ts, data in items:
+                old = self._rigs.get(rig_id)
+                entry = self._entry(old[0] if old else "online", data)
+                # Agent clocks running ahead land in the current minute
+                minute = min(ts, now) // SLOT_MS
+                for group in (FLEET, *entry[3]):
+                    window = self._windows.get(group)
+                    if window is None:
+                        window = self._windows[group] = SlidingWindow()
+                    window.add(minute, entry[5], entry[1])
+                # Replayed history feeds the windows but not the current state
+                if ts >= self._latest_ts.get(rig_id, ts):
+                    self._latest_ts[rig_id] = ts
+                    self._set(rig_id, entry)
+
+    def set_status(self, statuses: Dict[str, str]) -> None:
+        with self._lock:
+            for rig_id, status in statuses.items():
+                entry = self._rigs.get(rig_id)
+                if entry is not None and entry[0] != status:
+                    self._set(rig_id, (status, *entry[1:]))
+
+    def _flags(self, key: GroupKey) -> Dict[str, int]:
+        counts = self._counts.get(key, {})
+        return {flag: counts.get(flag, 0) for flag in ("rigs", "online", "busy", "free")}
+
+    def summary(self) -> Dict[str, Any]:
+        now = int(time.time() * 1000)
+        with self._lock:
+            window = self._windows.get(FLEET)
+            return {
+                **self._flags(FLEET),
+                "status": dict(self._status),
+                "capabilities": {
+                    key[1]: self._flags(key)
+                    for key in sorted(key for key in self._counts if key[0] == "capability")
+                },
+                "running": dict(sorted(self._running.items())),
+                "current": {
+                    metric: round(self._metric_sums[metric] / self._metric_counts[metric], 1)
+                    if self._metric_counts[metric] else None
+                    for metric in WINDOW_METRICS
+                },
+                "last_hour": window.summarize(now // SLOT_MS, SLOTS) if window else None,
+            }
+
+    def utilization(self, group_by: str, minutes: int) -> List[Dict[str, Any]]:
+        now = int(time.time() * 1000)
+        with self._lock:
+            values = {value for field, value in self._counts if field == group_by}
+            values.update(value for field, value in self._windows if field == group_by)
+            groups = []
+            for value in sorted(values, key=lambda value: (value is None, value or "")):
+                window = self._windows.get((group_by, value))
+                groups.append({
+                    group_by: value,
+                    **self._flags((group_by, value)),
+                    **(window.summarize(now // SLOT_MS, minutes) if window else EMPTY_SUMMARY),
+                })
+            return groups
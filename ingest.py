@@ -0,0 +1,155 @@
+# ingest.py
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, List, Optional
+from storage import Heartbeat
+
+logger = logging.getLogger("vigilant")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class IngestQueue:
+    # write_batch commits a batch and returns the heartbeats it actually
+    # inserted; apply_batch then gets (batch, inserted) once per commit
+    def __init__(
+        self,
+        write_batch: Callable[[List[Heartbeat]], List[Heartbeat]],
+        apply_batch: Optional[Callable[[List[Heartbeat], List[Heartbeat]], None]] = None,
+        max_size: int = 10000,
+        batch_size: int = 500,
+        max_latency: float = 0.05,
+        write_retries: int = 3,
+        name: str = "vigilant-ingest",
+    ) -> None:
+        self.write_batch = write_batch
+        self.apply_batch = apply_batch
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.write_retries = write_retries
+        self.name = name
+
+        self._items: Deque[Heartbeat] = deque()
+        # Recent commit durations in seconds, and running totals
+        self.commit_times: Deque[float] = deque(maxlen=1000)
+        self.written = 0
+        # Size of the batch being written, counted as pending until it commits
+        self._writing = 0
+        self.batches = 0
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def pending(self) -> int:
+        return len(self._items) + self._writing
+
+    def start(self) -> None:
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name=self.name, daemon=True
+        )
+        self._thread.start()
+
+    def put(self, item: Heartbeat) -> None:
+        self.put_many([item])
+
+    def put_many(self, items: List[Heartbeat]) -> None:
+        # All or nothing, so a batch is never half-queued
+        with self._cond:
+            if self._stopping:
+                raise QueueFull("Ingest queue is shutting down")
+            if len(self._items) + len(items) > self.max_size:
+                raise QueueFull("Ingest queue is full")
+            self._items.extend(items)
+            self._cond.notify()
+
+    def stop(self, timeout: float = 30.0) -> None:
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._items:
+            logger.error(f"Ingest queue stopped with {len(self._items)} unwritten heartbeats")
+
+    def _next_batch(self) -> List[Heartbeat]:
+        with self._cond:
+            while not self._items and not self._stopping:
+                self._cond.wait()
+
+            # Give concurrent requests a short window to join this commit
+            deadline = time.monotonic() + self.max_latency
+            while len(self._items) < self.batch_size and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            count = min(len(self._items), self.batch_size)
+            self._writing = count
+            return [self._items.popleft() for _ in range(count)]
+
+    def _write(self, batch: List[Heartbeat]) -> None:
+        inserted: Optional[List[Heartbeat]] = None
+        for attempt in range(1, self.write_retries + 1):
+            try:
+                started = time.perf_counter()
+                inserted = self.write_batch(batch)
+                self.commit_times.append(time.perf_counter() - started)
+                self.written += len(batch)
+                self.batches += 1
+                break
+            except sqlite3.OperationalError as e:
+                logger.warning(f"Ingest write failed (attempt {attempt}): {e}")
+                time.sleep(0.1 * attempt)
+            except Exception as e:
+                if len(batch) == 1:
+                    logger.exception(f"Ingest write failed: {e}")
+                else:
+                    logger.warning(f"Ingest write of {len(batch)} heartbeats failed, splitting: {e}")
+                break
+        else:
+            logger.error(f"Dropped {len(batch)} heartbeats after failed writes")
+            return
+
+        if inserted is not None:
+            self._apply(batch, inserted)
+            return
+        if len(batch) == 1:
+            logger.error(f"Dropped heartbeat from {batch[0][0]} after a failed write")
+            return
+        # One bad heartbeat shouldn't cost the rest of the commit; halve the
+        # batch until the failing item is on its own
+        middle = len(batch) // 2
+        self._write(batch[:middle])
+        self._write(batch[middle:])
+
+    def _apply(self, batch: List[Heartbeat], inserted: List[Heartbeat]) -> None:
+        # The batch is committed by now; a failure here must never send it
+        # back through the write, where every row would count as a duplicate
+        if self.apply_batch is None:
+            return
+        try:
+            self.apply_batch(batch, inserted)
+        except Exception as e:
+            logger.exception(f"Applying {len(batch)} written heartbeats failed: {e}")
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+                self._writing = 0
+            elif self._stopping:
+                return
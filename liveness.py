@@ -0,0 +1,145 @@
+# liveness.py
+
+import heapq
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from storage import now_ms
+
+logger = logging.getLogger("vigilant")
+
+ONLINE = "online"
+STALE = "stale"
+OFFLINE = "offline"
+
+# (rig_id, ts, event, old_status, new_status)
+Transition = Tuple[str, int, str, Optional[str], str]
+
+
+class LivenessTracker:
+    def __init__(
+        self,
+        on_transitions: Callable[[List[Transition]], None],
+        interval: float = 60,
+        stale_after: float = 2.5,
+        offline_after: float = 5.0,
+    ) -> None:
+        # stale_after/offline_after are multiples of the rig's heartbeat interval
+        self.on_transitions = on_transitions
+        self.interval = interval
+        self.stale_after = stale_after
+        self.offline_after = offline_after
+
+        self._cond = threading.Condition()
+        # (deadline, generation, rig_id); superseded entries are skipped lazily
+        self._heap: List[Tuple[int, int, str]] = []
+        self._status: Dict[str, str] = {}
+        self._last_seen: Dict[str, int] = {}
+        self._intervals: Dict[str, float] = {}
+        self._generation: Dict[str, int] = {}
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+    def _window(self, rig_id: str, multiple: float) -> int:
+        return int(self._intervals.get(rig_id, self.interval) * multiple * 1000)
+
+    def _schedule(self, rig_id: str, deadline: int) -> None:
+        generation = self._generation.get(rig_id, 0) + 1
+        self._generation[rig_id] = generation
+        heapq.heappush(self._heap, (deadline, generation, rig_id))
+        if self._heap[0][2] == rig_id:
+            self._cond.notify()
+
+    def load(self, rigs: List[Dict[str, Any]]) -> None:
+        # rigs are {"rig_id", "status", "last_seen"} with last_seen in epoch ms
+        with self._cond:
+            for rig in rigs:
+                rig_id = rig["rig_id"]
+                status = rig["status"] or OFFLINE
+                self._status[rig_id] = status
+                self._last_seen[rig_id] = rig["last_seen"] or 0
+                if status == ONLINE:
+                    self._schedule(rig_id, self._last_seen[rig_id] + self._window(rig_id, self.stale_after))
+                elif status == STALE:
+                    self._schedule(rig_id, self._last_seen[rig_id] + self._window(rig_id, self.offline_after))
+
+    def set_interval(self, rig_id: str, interval: float) -> None:
+        with self._cond:
+            self._intervals[rig_id] = interval
+
+    def heartbeat(self, rig_id: str, ts: int) -> None:
+        now = now_ms()
+        transitions: List[Transition] = []
+        with self._cond:
+            # Replayed history must not bring a dead rig back online
+            if now - ts > self._window(rig_id, self.offline_after):
+                if rig_id not in self._status:
+                    self._status[rig_id] = OFFLINE
+                    self._last_seen[rig_id] = ts
+                    transitions.append((rig_id, ts, "registered", None, OFFLINE))
+            elif ts >= self._last_seen.get(rig_id, 0):
+                self._last_seen[rig_id] = ts
+                old_status = self._status.get(rig_id)
+                if old_status != ONLINE:
+                    self._status[rig_id] = ONLINE
+                    event = "registered" if old_status is None else "online"
+                    transitions.append((rig_id, ts, event, old_status, ONLINE))
+                self._schedule(rig_id, now + self._window(rig_id, self.stale_after))
+
+        if transitions:
+            self.on_transitions(transitions)
+
+    def status(self, rig_id: str) -> Optional[str]:
+        return self._status.get(rig_id)
+
+    def _expire(self, now: int) -> List[Transition]:
+        transitions: List[Transition] = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, generation, rig_id = heapq.heappop(self._heap)
+            if self._generation.get(rig_id) != generation:
+                continue
+
+            status = self._status.get(rig_id)
+            if status == ONLINE:
+                self._status[rig_id] = STALE
+                transitions.append((rig_id, deadline, "stale", ONLINE, STALE))
+                offline_at = self._last_seen[rig_id] + self._window(rig_id, self.offline_after)
+                self._schedule(rig_id, max(offline_at, deadline))
+            elif status == STALE:
+                self._status[rig_id] = OFFLINE
+                transitions.append((rig_id, deadline, "offline", STALE, OFFLINE))
+        return transitions
+
+    def start(self) -> None:
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name="vigilant-liveness", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    now = now_ms()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    timeout = (self._heap[0][0] - now) / 1000 if self._heap else None
+                    self._cond.wait(timeout)
+                if self._stopping:
+                    return
+                transitions = self._expire(now_ms())
+
+            if transitions:
+                try:
+                    self.on_transitions(transitions)
+                except Exception as e:
+                    logger.exception(f"Failed to record liveness transitions: {e}")
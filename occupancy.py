@@ -0,0 +1,197 @@
+# occupancy.py
+
+import json
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# A gap between heartbeats longer than this ends the current interval; the
+# time in between counts as unobserved rather than busy or idle
+MAX_GAP_MS = 15 * 60 * 1000
+
+# (start_ts, end_ts, running processes) of the interval a rig is in
+Interval = Tuple[int, int, Tuple[str, ...]]
+
+CREATE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS rig_occupancy (
+        rig_id TEXT NOT NULL,
+        start_ts INTEGER NOT NULL,
+        end_ts INTEGER NOT NULL,
+        busy INTEGER NOT NULL,
+        processes TEXT NOT NULL,
+        PRIMARY KEY (rig_id, start_ts)
+    ) WITHOUT ROWID
+"""
+
+# Narrower than the table, so range sweeps never read the process lists
+CREATE_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS idx_rig_occupancy_span
+    ON rig_occupancy (rig_id, start_ts, end_ts, busy)
+"""
+
+# The open interval is rewritten as it grows; end_ts never moves backwards
+UPSERT_SQL = """
+    INSERT INTO rig_occupancy (rig_id, start_ts, end_ts, busy, processes)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(rig_id, start_ts) DO UPDATE SET
+        end_ts = MAX(end_ts, excluded.end_ts),
+        busy = excluded.busy,
+        processes = excluded.processes
+"""
+
+SELECT_LAST_SQL = """
+    SELECT start_ts, end_ts, processes FROM rig_occupancy
+    WHERE rig_id = ?
+    ORDER BY start_ts DESC
+    LIMIT 1
+"""
+
+SELECT_BACKFILL_SQL = "SELECT rig_id, ts, data FROM heartbeats ORDER BY rig_id, ts"
+
+SELECT_FIRST_STARTS_SQL = "SELECT rig_id, MIN(start_ts) FROM rig_occupancy GROUP BY rig_id"
+
+# The interval a late heartbeat falls in, or the last one before it
+SELECT_COVERING_SQL = """
+    SELECT start_ts, processes FROM rig_occupancy
+    WHERE rig_id = ? AND start_ts <= ?
+    ORDER BY start_ts DESC
+    LIMIT 1
+"""
+
+DELETE_FROM_SQL = "DELETE FROM rig_occupancy WHERE rig_id = ? AND start_ts >= ?"
+
+SELECT_REBUILD_SQL = "SELECT ts, data FROM heartbeats WHERE rig_id = ? AND ts >= ? ORDER BY ts"
+
+# A rig's intervals never overlap, so the only one starting before 'from'
+# that can reach into the range is the last one; seeking to it keeps the
+# sweep to the intervals inside the range however long the history is
+FIRST_START_SQL = """
+    COALESCE((
+        SELECT MAX(start_ts) FROM rig_occupancy
+        WHERE rig_id = {rig} AND start_ts <= :start
+    ), 0)
+"""
+
+SELECT_RIG_SQL = f"""
+    SELECT start_ts, end_ts, busy, processes FROM rig_occupancy
+    WHERE rig_id = :rig_id
+        AND start_ts >= {FIRST_START_SQL.format(rig=":rig_id")}
+        AND start_ts < :end AND end_ts > :start
+    ORDER BY start_ts
+"""
+
+# CROSS JOIN pins rigs as the outer loop, so each rig is one index seek
+SELECT_FLEET_SQL = f"""
+    SELECT o.rig_id, o.busy,
+        SUM(MIN(o.end_ts, :end) - MAX(o.start_ts, :start)) AS ms,
+        COUNT(*) AS intervals
+    FROM rigs r
+    CROSS JOIN rig_occupancy o ON o.rig_id = r.rig_id
+        AND o.start_ts >= {FIRST_START_SQL.format(rig="r.rig_id")}
+        AND o.start_ts < :end AND o.end_ts > :start
+    GROUP BY o.rig_id, o.busy
+"""
+
+
+def running_processes(data: Dict[str, Any]) -> List[str]:
+    return sorted(key for key, value in data.items() if value == "running")
+
+
+def advance(
+    current: Dict[str, Interval], items: Iterable[Tuple[str, int, Dict[str, Any]]], max_gap: int = MAX_GAP_MS
+) -> Dict[Tuple[str, int], Tuple[Any, ...]]:
+    # Walks heartbeats in time order and moves each rig's open interval
+    # along, closing it whenever the set of running processes changes.
+    # Updates current in place and returns the rows to upsert. Heartbeats
+    # older than the open interval (replays, late retries) are left out;
+    # see late_starts() and rebuild() for those.
+    rows: Dict[Tuple[str, int], Tuple[Any, ...]] = {}
+    for rig_id, ts, data in sorted(items, key=lambda item: (item[0], item[1])):
+        running = tuple(running_processes(data))
+        interval = current.get(rig_id)
+        if interval is not None and ts < interval[1]:
+            continue
+        if interval is None or ts - interval[1] > max_gap:
+            interval = (ts, ts, running)
+        elif running == interval[2]:
+            interval = (interval[0], ts, running)
+        else:
+            # The change happened some time since the last heartbeat; the old
+            # state is assumed to have lasted until it was seen to end
+            rows[(rig_id, interval[0])] = _row(rig_id, (interval[0], ts, interval[2]))
+            interval = (ts, ts, running)
+        current[rig_id] = interval
+        rows[(rig_id, interval[0])] = _row(rig_id, interval)
+    return rows
+
+
+def late_starts(current: Dict[str, Interval], items: Iterable[Tuple[str, int, Any]]) -> Dict[str, int]:
+    # rig_id -> oldest heartbeat that lands behind the rig's open interval
+    late: Dict[str, int] = {}
+    for rig_id, ts, _ in items:
+        interval = current.get(rig_id)
+        if interval is not None and ts < interval[1]:
+            late[rig_id] = min(ts, late.get(rig_id, ts))
+    return late
+
+
+def rebuild(
+    conn: sqlite3.Connection, rig_id: str, since: int, max_gap: int = MAX_GAP_MS, chunk_size: int = 5000
+) -> Optional[Interval]:
+    # Re-derives a rig's intervals from its stored heartbeats, starting with
+    # the interval that holds (or precedes) 'since', so late heartbeats are
+    # merged in place of being dropped. An outbox replay is usually recent,
+    # so this reads little more than the replayed stretch. Returns the rig's
+    # new last interval.
+    row = conn.execute(SELECT_COVERING_SQL, (rig_id, since)).fetchone()
+    if row is not None:
+        since = row[0]
+    conn.execute(DELETE_FROM_SQL, (rig_id, since))
+    current: Dict[str, Interval] = {}
+    if row is not None:
+        # Restarted from its stored start and state, in case the heartbeats
+        # it began with have expired since
+        current[rig_id] = (row[0], row[0], tuple(json.loads(row[1])))
+        conn.execute(UPSERT_SQL, _row(rig_id, current[rig_id]))
+    cursor = conn.execute(SELECT_REBUILD_SQL, (rig_id, since))
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return current.get(rig_id)
+        items = [(rig_id, ts, json.loads(data or "{}")) for ts, data in rows]
+        conn.executemany(UPSERT_SQL, list(advance(current, items, max_gap).values()))
+
+
+def _row(rig_id: str, interval: Interval) -> Tuple[Any, ...]:
+    start_ts, end_ts, running = interval
+    return (rig_id, start_ts, end_ts, int(bool(running)), json.dumps(list(running)))
+
+
+def totals(busy_ms: int, idle_ms: int, span_ms: int) -> Dict[str, Any]:
+    observed = busy_ms + idle_ms
+    return {
+        "busy_ms": busy_ms,
+        "idle_ms": idle_ms,
+        "unobserved_ms": max(0, span_ms - observed),
+        # Share of the observed time, so offline stretches don't count as idle
+        "utilization": round(busy_ms / observed, 4) if observed else None,
+    }
+
+
+def backfill(conn: sqlite3.Connection, max_gap: int = MAX_GAP_MS, chunk_size: int = 5000) -> Dict[str, Interval]:
+    # Derives intervals from heartbeats older than their rig's first
+    # interval, one chunk at a time. Intervals already there (and a running
+    # server's idea of which one is open) stay untouched. Returns the last
+    # interval built per rig.
+    first_starts = dict(conn.execute(SELECT_FIRST_STARTS_SQL).fetchall())
+    current: Dict[str, Interval] = {}
+    cursor = conn.execute(SELECT_BACKFILL_SQL)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return current
+        items = [
+            (rig_id, ts, json.loads(data or "{}"))
+            for rig_id, ts, data in rows
+            if rig_id not in first_starts or ts < first_starts[rig_id]
+        ]
+        conn.executemany(UPSERT_SQL, list(advance(current, items, max_gap).values()))
@@ -0,0 +1,223 @@
+# retention.py
+
+import logging
+import math
+import os
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple
+
+from storage import now_ms
+
+if TYPE_CHECKING:
+    from shards import ShardedStorage
+
+logger = logging.getLogger("vigilant")
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+MAGIC = b"VGA1"
+
+# Columns kept in the archive, in file order after ts
+ARCHIVE_METRICS = ("cpu_percent", "memory_percent", "disk_percent")
+
+# rig_id -> (ts, cpu, memory, disk) arrays
+Columns = Tuple[array, array, array, array]
+
+
+def _to_little_endian(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode: str, data: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def _value(value: Any) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return math.nan
+    return float(value)
+
+
+class Archive:
+    def __init__(self, directory: Path) -> None:
+        self.directory = Path(directory)
+
+    def path_for(self, day_start: int) -> Path:
+        day = datetime.fromtimestamp(day_start / 1000, timezone.utc).strftime("%Y-%m-%d")
+        return self.directory / f"heartbeats-{day}.vga"
+
+    def _load(self, path: Path) -> Dict[str, Columns]:
+        raw = path.read_bytes()
+        if raw[:4] != MAGIC:
+            raise ValueError(f"Not a heartbeat archive: {path}")
+        payload = zlib.decompress(raw[4:])
+
+        columns: Dict[str, Columns] = {}
+        (rig_count,) = struct.unpack_from("<I", payload, 0)
+        offset = 4
+        for _ in range(rig_count):
+            (name_length,) = struct.unpack_from("<H", payload, offset)
+            offset += 2
+            rig_id = payload[offset:offset + name_length].decode()
+            offset += name_length
+            (count,) = struct.unpack_from("<I", payload, offset)
+            offset += 4
+
+            arrays = []
+            for typecode in ("q", "d", "d", "d"):
+                size = count * 8
+                arrays.append(_from_little_endian(typecode, payload[offset:offset + size]))
+                offset += size
+            columns[rig_id] = tuple(arrays)
+        return columns
+
+    def _dump(self, path: Path, columns: Dict[str, Columns]) -> None:
+        parts = [struct.pack("<I", len(columns))]
+        for rig_id, arrays in sorted(columns.items()):
+            name = rig_id.encode()
+            parts.append(struct.pack("<H", len(name)) + name)
+            parts.append(struct.pack("<I", len(arrays[0])))
+            parts.extend(_to_little_endian(values) for values in arrays)
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC + zlib.compress(b"".join(parts), 6))
+            f.flush()
+            os.fsync(f.fileno())
+        # Only replace the old file once the new one is safely on disk
+        os.replace(tmp_path, path)
+
+    def write_day(self, day_start: int, rows: List[Tuple[Any, ...]]) -> None:
+        # rows are (rig_id, ts, cpu, memory, disk); merged with anything already
+        # archived for the day so re-running after a crash is harmless
+        path = self.path_for(day_start)
+        merged: Dict[str, Dict[int, Tuple[float, float, float]]] = {}
+        if path.exists():
+            for rig_id, (ts, cpu, memory, disk) in self._load(path).items():
+                merged[rig_id] = {t: (c, m, d) for t, c, m, d in zip(ts, cpu, memory, disk)}
+
+        for rig_id, ts, cpu, memory, disk in rows:
+            merged.setdefault(rig_id, {})[ts] = (_value(cpu), _value(memory), _value(disk))
+
+        columns: Dict[str, Columns] = {}
+        for rig_id, samples in merged.items():
+            ordered = sorted(samples.items())
+            columns[rig_id] = (
+                array("q", (ts for ts, _ in ordered)),
+                array("d", (values[0] for _, values in ordered)),
+                array("d", (values[1] for _, values in ordered)),
+                array("d", (values[2] for _, values in ordered)),
+            )
+        self._dump(path, columns)
+
+    def read(self, rig_id: str, start: int, end: int) -> Iterator[Dict[str, Any]]:
+        day = start - start % DAY_MS
+        while day < end:
+            path = self.path_for(day)
+            day += DAY_MS
+            if not path.exists():
+                continue
+
+            arrays = self._load(path).get(rig_id)
+            if arrays is None:
+                continue
+            for ts, *values in zip(*arrays):
+                if start <= ts < end:
+                    row: Dict[str, Any] = {"rig_id": rig_id, "ts": ts}
+                    for metric, value in zip(ARCHIVE_METRICS, values):
+                        row[metric] = None if math.isnan(value) else value
+                    yield row
+
+
+class RetentionWorker:
+    def __init__(
+        self,
+        storage: "ShardedStorage",
+        archive: Archive,
+        retention_days: int,
+        interval: float = 3600,
+        delete_chunk: int = 1000,
+        vacuum_pages: int = 1000,
+    ) -> None:
+        self.storage = storage
+        self.archive = archive
+        self.retention_days = retention_days
+        self.interval = interval
+        self.delete_chunk = delete_chunk
+        self.vacuum_pages = vacuum_pages
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.retention_days <= 0:
+            logger.info("Retention disabled, keeping all raw heartbeats")
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="vigilant-retention", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.exception(f"Retention run failed: {e}")
+            self._stop.wait(self.interval)
+
+    def run_once(self) -> int:
+        cutoff = now_ms() - self.retention_days * DAY_MS
+        cutoff -= cutoff % DAY_MS
+
+        archived = 0
+        oldest = self.storage.oldest_heartbeat_ts()
+        while oldest is not None and oldest < cutoff and not self._stop.is_set():
+            day_start = oldest - oldest % DAY_MS
+            archived += self.archive_day(day_start)
+            oldest = self.storage.oldest_heartbeat_ts()
+        return archived
+
+    def archive_day(self, day_start: int) -> int:
+        day_end = day_start + DAY_MS
+        rows = self.storage.heartbeat_columns(day_start, day_end, ARCHIVE_METRICS)
+        if rows:
+            self.archive.write_day(day_start, rows)
+
+        # Only the rows just archived are removed, so a heartbeat for the day
+        # stored after the read (an outbox replay) stays for the next pass.
+        # Deletes go per rig in small transactions so the ingest writer never
+        # waits long for the write lock.
+        archived: Dict[str, List[int]] = {}
+        for row in rows:
+            archived.setdefault(row[0], []).append(row[1])
+        deleted = 0
+        for rig_id, timestamps in sorted(archived.items()):
+            for offset in range(0, len(timestamps), self.delete_chunk):
+                if self._stop.is_set():
+                    break
+                deleted += self.storage.delete_heartbeats(rig_id, timestamps[offset:offset + self.delete_chunk])
+        self.storage.incremental_vacuum(self.vacuum_pages)
+
+        logger.info(f"Archived {len(rows)} heartbeats to {self.archive.path_for(day_start)}")
+        return deleted
@@ -0,0 +1,177 @@
+# rollups.py
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Bucket widths in milliseconds, finest first
+RESOLUTIONS = {
+    "1m": 60 * 1000,
+    "1h": 60 * 60 * 1000,
+    "1d": 24 * 60 * 60 * 1000,
+}
+
+# Column prefix in the rollup tables -> heartbeat field
+ROLLUP_METRICS = {
+    "cpu": "cpu_percent",
+    "memory": "memory_percent",
+    "disk": "disk_percent",
+}
+
+AGGREGATES = ("min", "max", "sum", "count", "last")
+
+ROLLUP_COLUMNS = [f"{prefix}_{agg}" for prefix in ROLLUP_METRICS for agg in AGGREGATES]
+
+
+def table_name(resolution: str) -> str:
+    return f"rollup_{resolution}"
+
+
+def create_table_sql(resolution: str) -> str:
+    columns = "".join(
+        f"{prefix}_min REAL, {prefix}_max REAL, {prefix}_sum REAL, "
+        f"{prefix}_count INTEGER NOT NULL DEFAULT 0, {prefix}_last REAL, "
+        for prefix in ROLLUP_METRICS
+    )
+    return f"""
+        CREATE TABLE IF NOT EXISTS {table_name(resolution)} (
+            rig_id TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            samples INTEGER NOT NULL,
+            last_ts INTEGER NOT NULL,
+            {columns}
+            PRIMARY KEY (rig_id, bucket)
+        ) WITHOUT ROWID
+    """
+
+
+def backfill_sql(resolution: str) -> str:
+    # Builds a rollup table from whatever is already in heartbeats
+    width = RESOLUTIONS[resolution]
+    grouped = []
+    selects = []
+    for prefix, field in ROLLUP_METRICS.items():
+        grouped.append(
+            f"MIN({field}) AS {prefix}_min, MAX({field}) AS {prefix}_max, "
+            f"SUM({field}) AS {prefix}_sum, COUNT({field}) AS {prefix}_count"
+        )
+        selects.append(
+            f"g.{prefix}_min, g.{prefix}_max, g.{prefix}_sum, g.{prefix}_count, "
+            f"(SELECT l.{field} FROM heartbeats l WHERE l.rig_id = g.rig_id "
+            f"AND l.ts >= g.bucket AND l.ts <= g.last_ts AND l.{field} IS NOT NULL "
+            f"ORDER BY l.ts DESC LIMIT 1)"
+        )
+    return f"""
+        INSERT OR REPLACE INTO {table_name(resolution)}
+            (rig_id, bucket, samples, last_ts, {", ".join(ROLLUP_COLUMNS)})
+        SELECT g.rig_id, g.bucket, g.samples, g.last_ts, {", ".join(selects)}
+        FROM (
+            SELECT rig_id, (ts / {width}) * {width} AS bucket, COUNT(*) AS samples,
+                MAX(ts) AS last_ts, {", ".join(grouped)}
+            FROM heartbeats
+            GROUP BY rig_id, ts / {width}
+        ) g
+    """
+
+
+def upsert_sql(resolution: str) -> str:
+    updates = ["samples = samples + excluded.samples"]
+    for prefix in ROLLUP_METRICS:
+        updates += [
+            f"{prefix}_min = MIN(COALESCE({prefix}_min, excluded.{prefix}_min), "
+            f"COALESCE(excluded.{prefix}_min, {prefix}_min))",
+            f"{prefix}_max = MAX(COALESCE({prefix}_max, excluded.{prefix}_max), "
+            f"COALESCE(excluded.{prefix}_max, {prefix}_max))",
+            f"{prefix}_sum = COALESCE({prefix}_sum, 0) + COALESCE(excluded.{prefix}_sum, 0)",
+            f"{prefix}_count = {prefix}_count + excluded.{prefix}_count",
+            f"{prefix}_last = CASE WHEN excluded.last_ts >= last_ts "
+            f"AND excluded.{prefix}_last IS NOT NULL "
+            f"THEN excluded.{prefix}_last ELSE {prefix}_last END",
+        ]
+    # All expressions see the old row, so last_ts is updated last on purpose
+    updates.append("last_ts = MAX(last_ts, excluded.last_ts)")
+    return f"""
+        INSERT INTO {table_name(resolution)}
+            (rig_id, bucket, samples, last_ts, {", ".join(ROLLUP_COLUMNS)})
+        VALUES (?, ?, ?, ?, {", ".join("?" for _ in ROLLUP_COLUMNS)})
+        ON CONFLICT(rig_id, bucket) DO UPDATE SET
+            {", ".join(updates)}
+    """
+
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return float(value)
+
+
+def aggregate(
+    items: Iterable[Tuple[str, int, Dict[str, Any]]], width: int
+) -> List[Tuple[Any, ...]]:
+    # Pre-aggregates a batch in Python so each bucket costs one upsert
+    buckets: Dict[Tuple[str, int], Dict[str, Any]] = {}
+    for rig_id, ts, data in items:
+        key = (rig_id, ts - ts % width)
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = {"samples": 0, "last_ts": ts}
+            for prefix in ROLLUP_METRICS:
+                bucket[prefix] = [None, None, None, 0, None, None]
+
+        bucket["samples"] += 1
+        bucket["last_ts"] = max(bucket["last_ts"], ts)
+        for prefix, field in ROLLUP_METRICS.items():
+            value = _number(data.get(field))
+            if value is None:
+                continue
+            low, high, total, count, last, last_ts = bucket[prefix]
+            bucket[prefix] = [
+                value if low is None else min(low, value),
+                value if high is None else max(high, value),
+                value if total is None else total + value,
+                count + 1,
+                value if last_ts is None or ts >= last_ts else last,
+                ts if last_ts is None or ts >= last_ts else last_ts,
+            ]
+
+    rows = []
+    for (rig_id, start), bucket in buckets.items():
+        values: List[Any] = []
+        for prefix in ROLLUP_METRICS:
+            values += bucket[prefix][:5]
+        rows.append((rig_id, start, bucket["samples"], bucket["last_ts"], *values))
+    return rows
+
+
+def choose_resolution(start: int, end: int, points: int) -> str:
+    # Coarsest rollup that still yields the requested number of points
+    for resolution in sorted(RESOLUTIONS, key=RESOLUTIONS.get, reverse=True):
+        if (end - start) / RESOLUTIONS[resolution] >= points:
+            return resolution
+    return "raw"
+
+
+def rollup_point(row: Dict[str, Any]) -> Dict[str, Any]:
+    point: Dict[str, Any] = {"ts": row["bucket"], "samples": row["samples"]}
+    for prefix, field in ROLLUP_METRICS.items():
+        count = row[f"{prefix}_count"]
+        point[field] = {
+            "min": row[f"{prefix}_min"],
+            "max": row[f"{prefix}_max"],
+            "avg": row[f"{prefix}_sum"] / count if count else None,
+            "last": row[f"{prefix}_last"],
+            "count": count,
+        }
+    return point
+
+
+def raw_point(row: Dict[str, Any]) -> Dict[str, Any]:
+    point: Dict[str, Any] = {"ts": row["ts"], "samples": 1}
+    for field in ROLLUP_METRICS.values():
+        value = row[field]
+        point[field] = {
+            "min": value,
+            "max": value,
+            "avg": value,
+            "last": value,
+            "count": 0 if value is None else 1,
+        }
+    return point
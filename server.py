@@ -1,57 +1,267 @@
 # server.py
 
-from fastapi import FastAPI, HTTPException, Header
-from typing import Optional, Dict, Any
-import sqlite3
-from datetime import datetime, timezone
+from fastapi import FastAPI, HTTPException, Header, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, Iterator, Iterable, List, Tuple
 from pathlib import Path
 import os
+import argparse
+import csv
+import io
 import uvicorn
 import json
+import math
+import time
+import zlib
+import msgpack
+import metrics
+import occupancy
+import rollups
+from admission import Admission, Backpressure, retry_after_header
+from agentconfig import FLEET, MIN_INTERVAL_S, AgentConfigs, validate_config
+from delta import DeltaDecoder, KeyframeRequired
+from fleet import GROUP_FIELDS, SLOTS, FleetAggregates
+from ingest import IngestQueue, QueueFull
+from liveness import LivenessTracker, Transition
+from metrics import COUNT_BUCKETS, Counter, Gauge, Histogram, MetricsMiddleware, percentiles
+from retention import Archive, RetentionWorker
+from shards import ShardedStorage, existing_layouts, reshard, shard_index
+from state import SORT_KEYS, RigState, etag_matches, running_processes
+from stream import Broker, SubscriberLimit, format_event
+from storage import HOT_METRICS, SCHEMA_VERSION, Heartbeat, format_timestamp, now_ms, parse_timestamp, try_parse_timestamp
 
 API_KEY = os.getenv("API_KEY", "your-api-key-here")
-DB_PATH = Path(__file__).parent / "vigilant.db"
+DB_PATH = Path(os.getenv("DB_PATH", Path(__file__).parent / "vigilant.db"))
+DB_SHARDS = int(os.getenv("DB_SHARDS", 1))
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", Path(__file__).parent / "archive"))
 PORT = int(os.getenv("PORT", 8000))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 1000))
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_BYTES", 16 * 1024 * 1024))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 10000))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 500))
+INGEST_MAX_LATENCY_MS = int(os.getenv("INGEST_MAX_LATENCY_MS", 50))
+INGEST_RETRY_AFTER = int(os.getenv("INGEST_RETRY_AFTER", 5))
+MAX_CLOCK_SKEW_S = int(os.getenv("MAX_CLOCK_SKEW_S", 3600))
+INGEST_MAX_INFLIGHT = int(os.getenv("INGEST_MAX_INFLIGHT", 64))
+# Uncommitted heartbeats across all shards before new requests get a 503
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", INGEST_QUEUE_SIZE * DB_SHARDS // 2))
+RIG_RATE_PER_MIN = float(os.getenv("RIG_RATE_PER_MIN", 6))
+RIG_BURST = float(os.getenv("RIG_BURST", 10))
+METRICS_DEFAULT_RANGE_HOURS = int(os.getenv("METRICS_DEFAULT_RANGE_HOURS", 24))
+METRICS_DEFAULT_POINTS = int(os.getenv("METRICS_DEFAULT_POINTS", 300))
+HEARTBEAT_INTERVAL_S = int(os.getenv("HEARTBEAT_INTERVAL_S", 60))
+ADAPTIVE_INTERVALS = os.getenv("ADAPTIVE_INTERVALS", "1") == "1"
+STALE_AFTER_INTERVALS = float(os.getenv("STALE_AFTER_INTERVALS", 2.5))
+OFFLINE_AFTER_INTERVALS = float(os.getenv("OFFLINE_AFTER_INTERVALS", 5))
+OCCUPANCY_MAX_GAP_S = int(os.getenv("OCCUPANCY_MAX_GAP_S", occupancy.MAX_GAP_MS // 1000))
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", 30))
+RETENTION_INTERVAL_S = int(os.getenv("RETENTION_INTERVAL_S", 3600))
+RETENTION_DELETE_CHUNK = int(os.getenv("RETENTION_DELETE_CHUNK", 1000))
+STREAM_MAX_SUBSCRIBERS = int(os.getenv("STREAM_MAX_SUBSCRIBERS", 100))
+STREAM_MAX_EVENTS = int(os.getenv("STREAM_MAX_EVENTS", 1000))
+STREAM_KEEPALIVE_S = int(os.getenv("STREAM_KEEPALIVE_S", 15))
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", 64 * 1024))
+SQLITE_READERS = int(os.getenv("SQLITE_READERS", 4))
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+archive = Archive(ARCHIVE_DIR)
+
+storage = ShardedStorage(
+    DB_PATH,
+    shards=DB_SHARDS,
+    readers=SQLITE_READERS,
+    pragmas={
+        "synchronous": SQLITE_SYNCHRONOUS,
+        "mmap_size": SQLITE_MMAP_SIZE,
+        "busy_timeout": SQLITE_BUSY_TIMEOUT_MS,
+    },
+    archive=archive,
+    occupancy_gap=OCCUPANCY_MAX_GAP_S * 1000,
+)
+
+rig_state = RigState()
+fleet = FleetAggregates()
+# The per-rig token bucket refills one heartbeat every 60 / RIG_RATE_PER_MIN
+# seconds; configs asking for more than that would be throttled forever
+MIN_AGENT_INTERVAL_S = max(MIN_INTERVAL_S, 60 / RIG_RATE_PER_MIN)
+agent_configs = AgentConfigs(HEARTBEAT_INTERVAL_S, adaptive=ADAPTIVE_INTERVALS, min_interval=MIN_AGENT_INTERVAL_S)
+delta_decoder = DeltaDecoder()
+
+admission = Admission(
+    rate=RIG_RATE_PER_MIN / 60,
+    burst=RIG_BURST,
+    max_inflight=INGEST_MAX_INFLIGHT,
+    spread=HEARTBEAT_INTERVAL_S,
+    overload_retry_after=INGEST_RETRY_AFTER,
+    pending=lambda: sum(ingest_queue.pending for ingest_queue in ingest_queues),
+    max_pending=INGEST_MAX_PENDING,
+)
+
+broker = Broker(max_subscribers=STREAM_MAX_SUBSCRIBERS, max_events=STREAM_MAX_EVENTS)
+
+
+def record_transitions(transitions: List[Transition]) -> None:
+    storage.record_events([
+        (rig_id, ts, event, old_status, new_status, None)
+        for rig_id, ts, event, old_status, new_status in transitions
+    ])
+    statuses = {rig_id: new_status for rig_id, _, _, _, new_status in transitions}
+    rig_state.set_status(statuses)
+    fleet.set_status(statuses)
+
+    for rig_id, ts, event, old_status, new_status in transitions:
+        broker.publish_event({
+            "type": "status",
+            "rig_id": rig_id,
+            "timestamp": format_timestamp(ts),
+            "event": event,
+            "old_status": old_status,
+            "new_status": new_status,
+        }, rig_state.attributes(rig_id))
+
+
+def publish_updates(updates: List[Dict[str, Any]]) -> None:
+    if not len(broker):
+        return
+    for update in updates:
+        attributes = rig_state.attributes(update["rig_id"])
+        broker.publish_update(update, attributes)
+        for action in ("started", "stopped"):
+            for process in update[action]:
+                broker.publish_event({
+                    "type": "process",
+                    "rig_id": update["rig_id"],
+                    "timestamp": update["timestamp"],
+                    "process": process,
+                    "action": action,
+                }, attributes)
+
+
+liveness = LivenessTracker(
+    record_transitions,
+    interval=HEARTBEAT_INTERVAL_S,
+    stale_after=STALE_AFTER_INTERVALS,
+    offline_after=OFFLINE_AFTER_INTERVALS,
+)
+
+
+HEARTBEATS_ACCEPTED = Counter("vigilant_heartbeats_accepted_total", "Heartbeats accepted into the ingest queue")
+HEARTBEATS_REJECTED = Counter(
+    "vigilant_heartbeats_rejected_total", "Heartbeats refused by the API", labels=("reason",)
+)
+INGEST_THROTTLED = Counter(
+    "vigilant_ingest_throttled_total", "Heartbeat requests answered with 429 or 503", labels=("reason",)
+)
+HEARTBEATS_INGESTED = Counter("vigilant_heartbeats_ingested_total", "New heartbeats written to the database")
+INGEST_BATCH_ITEMS = Histogram(
+    "vigilant_ingest_batch_size", "Heartbeats per ingest commit", buckets=COUNT_BUCKETS
+)
+INGEST_WRITE_SECONDS = Histogram(
+    "vigilant_ingest_write_seconds", "Time to commit a batch of heartbeats"
+)
+
+
+def write_heartbeats(shard: int, items: List[Heartbeat]) -> List[Heartbeat]:
+    started = time.perf_counter()
+    inserted = storage.shards[shard].store_heartbeats(items)
+    HEARTBEATS_INGESTED.inc(len(inserted))
+    INGEST_BATCH_ITEMS.observe(len(items))
+    INGEST_WRITE_SECONDS.observe(time.perf_counter() - started)
+    return inserted
+
+
+def apply_heartbeats(items: List[Heartbeat], inserted: List[Heartbeat]) -> None:
+    # Replays and re-sent batches are stored once; only new heartbeats feed
+    # the in-memory state, so the fleet windows never count one twice
+    updates = rig_state.apply_heartbeats(inserted)
+    fleet.apply(inserted)
+
+    newest: Dict[str, int] = {}
+    for rig_id, ts, _ in items:
+        newest[rig_id] = max(ts, newest.get(rig_id, ts))
+    for rig_id, ts in newest.items():
+        liveness.heartbeat(rig_id, ts)
+    publish_updates(updates)
 
-app = FastAPI(title="Vigilant API", version="0.1.0")
-
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Rigs table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS rigs (
-            rig_id TEXT PRIMARY KEY,
-            hostname TEXT,
-            ip_address TEXT,
-            first_seen TEXT,
-            last_seen TEXT,
-            status TEXT DEFAULT 'offline'
-        )
-    """)
-    
-    # Heartbeats table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS heartbeats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            rig_id TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
-            cpu_percent REAL,
-            memory_percent REAL,
-            disk_percent REAL,
-            data TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (rig_id) REFERENCES rigs(rig_id)
-        )
-    """)
-    
-    conn.commit()
-    conn.close()
 
+# One queue and writer thread per shard; a rig always maps to the same
+# shard, so its heartbeats are still applied in order
+ingest_queues = [
+    IngestQueue(
+        lambda items, shard=shard: write_heartbeats(shard, items),
+        apply_heartbeats,
+        max_size=INGEST_QUEUE_SIZE,
+        batch_size=INGEST_BATCH_SIZE,
+        max_latency=INGEST_MAX_LATENCY_MS / 1000,
+        name=f"vigilant-ingest-{shard}",
+    )
+    for shard in range(DB_SHARDS)
+]
 
-# Initialize database on startup
-init_db()
+retention = RetentionWorker(
+    storage,
+    archive,
+    RETENTION_DAYS,
+    interval=RETENTION_INTERVAL_S,
+    delete_chunk=RETENTION_DELETE_CHUNK,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Initialize database on startup
+    storage.open()
+    rigs = storage.list_rigs()
+    rig_state.load(rigs, storage.latest_heartbeats())
+    fleet.load(rig_state.snapshot())
+    agent_configs.load(storage.agent_configs())
+    liveness.load([
+        {**rig, "last_seen": try_parse_timestamp(rig["last_seen"]) if rig["last_seen"] else None}
+        for rig in rigs
+    ])
+    liveness.start()
+    for ingest_queue in ingest_queues:
+        ingest_queue.start()
+    retention.start()
+    yield
+    retention.stop()
+    # Flush everything still queued before the process exits
+    for ingest_queue in ingest_queues:
+        ingest_queue.stop()
+    liveness.stop()
+    storage.close()
+
+
+app = FastAPI(title="Vigilant API", version="0.1.0", lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+
+Gauge("vigilant_ingest_queue_depth", "Heartbeats waiting for the ingest writer", lambda: sum(map(len, ingest_queues)))
+Gauge("vigilant_ingest_inflight", "Heartbeat requests being decoded and queued", lambda: admission.inflight)
+Gauge(
+    "vigilant_ingest_pending",
+    "Heartbeats accepted but not yet committed",
+    lambda: sum(ingest_queue.pending for ingest_queue in ingest_queues),
+)
+Gauge("vigilant_stream_subscribers", "Open event stream connections", lambda: len(broker))
+Gauge("vigilant_rigs", "Rigs known to the server", lambda: len(rig_state))
+Gauge("vigilant_delta_states", "Rigs with a delta protocol base state", lambda: len(delta_decoder))
+
+
+@app.exception_handler(Backpressure)
+def backpressure_handler(request: Request, exc: Backpressure):
+    INGEST_THROTTLED.inc(reason=exc.reason)
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={
+            "status": exc.reason,
+            "retry_after": round(float(exc.retry_after), 1),
+            "next_send_offset": round(exc.next_send_offset, 1),
+        },
+        headers={"Retry-After": retry_after_header(exc.retry_after)},
+    )
 
 
 def verify_api_key(authorization: Optional[str] = Header(None)):
@@ -70,92 +280,778 @@ def root():
     return {"service": "Vigilant API", "version": "0.1.0", "status": "running"}
 
 
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/stats")
+def stats():
+    # list() copies each deque in one step; iterating it in Python would race
+    # the writer threads appending to it
+    commit_times = [list(ingest_queue.commit_times) for ingest_queue in ingest_queues]
+    shards = [
+        {
+            "queued": len(ingest_queue),
+            "written": ingest_queue.written,
+            "batches": ingest_queue.batches,
+            "commit_ms": percentiles(times),
+        }
+        for ingest_queue, times in zip(ingest_queues, commit_times)
+    ]
+    return {
+        "rigs": len(rig_state),
+        "ingest": {
+            "queued": sum(shard["queued"] for shard in shards),
+            "written": sum(shard["written"] for shard in shards),
+            "batches": sum(shard["batches"] for shard in shards),
+            "commit_ms": percentiles([t for times in commit_times for t in times]),
+            "shards": shards,
+        },
+        "stream_subscribers": len(broker),
+    }
+
+
+def enqueue_heartbeats(items: List[Heartbeat]) -> None:
+    parts: Dict[int, List[Heartbeat]] = {}
+    for item in items:
+        parts.setdefault(shard_index(item[0], DB_SHARDS), []).append(item)
+
+    accepted = 0
+    try:
+        for shard, part in parts.items():
+            ingest_queues[shard].put_many(part)
+            accepted += len(part)
+        HEARTBEATS_ACCEPTED.inc(accepted)
+    except QueueFull:
+        # Shards queued before the full one keep their part; the agent
+        # re-sends the batch and already stored heartbeats are ignored
+        HEARTBEATS_ACCEPTED.inc(accepted)
+        HEARTBEATS_REJECTED.inc(len(items) - accepted, reason="queue_full")
+        raise admission.overloaded(items[0][0])
+
+
+# 2000-01-01T00:00:00Z
+MIN_TIMESTAMP_MS = 946684800000
+
+
+def has_non_finite(value: Any) -> bool:
+    # JSON and msgpack both carry Infinity and NaN, which can neither be
+    # aggregated nor served back as JSON
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, float) and not math.isfinite(value):
+            return True
+        if isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+    return False
+
+
+def validate_heartbeat(data: Any) -> Tuple[str, int]:
+    if not isinstance(data, dict):
+        raise ValueError("Heartbeat must be an object")
+
+    rig_id = data.get("rig_id")
+    if not rig_id or not isinstance(rig_id, str):
+        raise ValueError("Missing rig_id")
+
+    for metric in HOT_METRICS:
+        value = data.get(metric)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise ValueError(f"Invalid {metric}")
+    if has_non_finite(data):
+        raise ValueError("Metric values must be finite")
+
+    timestamp = data.get("timestamp")
+    if not timestamp:
+        return rig_id, now_ms()
+    try:
+        ts = parse_timestamp(timestamp)
+    except ValueError:
+        raise ValueError("Invalid timestamp")
+    # Anything outside this can't be formatted back, or is a broken clock
+    if not MIN_TIMESTAMP_MS <= ts <= now_ms() + MAX_CLOCK_SKEW_S * 1000:
+        raise ValueError("Invalid timestamp")
+    return rig_id, ts
+
+
+DECODED_BODY_BYTES = Histogram(
+    "vigilant_decoded_body_bytes",
+    "Heartbeat body size after decompression",
+    labels=("encoding",),
+    buckets=metrics.SIZE_BUCKETS,
+)
+
+
+def decode_body(body: bytes, content_type: str, content_encoding: str) -> Any:
+    if content_encoding in ("gzip", "deflate"):
+        # Bounded decompression so a small gzip bomb can't exhaust memory
+        wbits = 16 + zlib.MAX_WBITS if content_encoding == "gzip" else zlib.MAX_WBITS
+        decompressor = zlib.decompressobj(wbits=wbits)
+        try:
+            body = decompressor.decompress(body, MAX_BATCH_BYTES)
+        except zlib.error:
+            raise HTTPException(status_code=400, detail=f"Invalid {content_encoding} body")
+        if decompressor.unconsumed_tail:
+            raise HTTPException(status_code=413, detail="Body too large")
+    elif content_encoding not in ("", "identity"):
+        raise HTTPException(status_code=415, detail=f"Unsupported encoding: {content_encoding}")
+    DECODED_BODY_BYTES.observe(len(body), encoding=content_encoding or "identity")
+
+    try:
+        if content_type in ("application/msgpack", "application/x-msgpack"):
+            return msgpack.unpackb(body, raw=False)
+        elif content_type in ("", "application/json"):
+            return json.loads(body)
+        else:
+            raise HTTPException(status_code=415, detail=f"Unsupported content type: {content_type}")
+    except (ValueError, msgpack.UnpackException):
+        raise HTTPException(status_code=400, detail="Malformed body")
+
+
+async def read_body(request: Request) -> Any:
+    body = await request.body()
+    if len(body) > MAX_BATCH_BYTES:
+        raise HTTPException(status_code=413, detail="Body too large")
+    
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    content_encoding = request.headers.get("content-encoding", "").strip().lower()
+    return decode_body(body, content_type, content_encoding)
+
+
+def decode_batch(payload: Any) -> List[Any]:
+    # Accept either a bare array or {"heartbeats": [...]}
+    if isinstance(payload, dict):
+        payload = payload.get("heartbeats")
+    if not isinstance(payload, list):
+        raise HTTPException(status_code=400, detail="Batch must be an array of heartbeats")
+    if len(payload) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {MAX_BATCH_SIZE} heartbeats")
+
+    return payload
+
+
+def agent_directives(rig_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    # Only agents that report a config_version act on these; older ones keep
+    # their own interval, and liveness keeps the default window for them
+    if "config_version" not in data:
+        return {}
+    interval = agent_configs.interval_for(rig_id, data, bool(running_processes(data)))
+    liveness.set_interval(rig_id, interval)
+    directives: Dict[str, Any] = {"interval": interval}
+    version, doc = agent_configs.effective(rig_id)
+    if data["config_version"] != version:
+        directives["config_version"] = version
+        directives["config"] = doc
+    return directives
+
+
 @app.post("/api/heartbeat")
 def receive_heartbeat(data: Dict[str, Any], authorization: Optional[str] = Header(None)):
     verify_api_key(authorization)
     
-    rig_id = data.get("rig_id")
-    if not rig_id:
-        raise HTTPException(status_code=400, detail="Missing rig_id")
-    
-    timestamp = data.get("timestamp", datetime.now(timezone.utc).isoformat())
-    
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Update or insert rig
-    cursor.execute("SELECT rig_id FROM rigs WHERE rig_id = ?", (rig_id,))
-    if cursor.fetchone():
-        cursor.execute("""
-            UPDATE rigs 
-            SET last_seen = ?, status = 'online', hostname = ?, ip_address = ?
-            WHERE rig_id = ?
-        """, (timestamp, data.get("hostname"), data.get("ip_address"), rig_id))
-    else:
-        cursor.execute("""
-            INSERT INTO rigs (rig_id, hostname, ip_address, first_seen, last_seen, status)
-            VALUES (?, ?, ?, ?, ?, 'online')
-        """, (rig_id, data.get("hostname"), data.get("ip_address"), timestamp, timestamp))
+    try:
+        rig_id, ts = validate_heartbeat(data)
+    except ValueError as e:
+        HEARTBEATS_REJECTED.inc(reason="invalid")
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    with admission.slot():
+        admission.check_rate([rig_id])
+        enqueue_heartbeats([(rig_id, ts, data)])
+    
+    return {
+        "status": "success",
+        "rig_id": rig_id,
+        "timestamp": format_timestamp(ts),
+        **agent_directives(rig_id, data),
+    }
+
+
+@app.post("/api/heartbeat/delta")
+async def receive_heartbeat_delta(request: Request, authorization: Optional[str] = Header(None)):
+    verify_api_key(authorization)
+    
+    with admission.slot():
+        return await accept_delta(request)
+
+
+async def accept_delta(request: Request):
+    frame = await read_body(request)
+    if not isinstance(frame, dict):
+        raise HTTPException(status_code=400, detail="Frame must be an object")
+    
+    # Checked before the frame is applied, so a throttled frame doesn't
+    # move the rig's delta base
+    if isinstance(frame.get("rig_id"), str):
+        admission.check_rate([frame["rig_id"]])
+    try:
+        data = delta_decoder.apply(frame)
+    except KeyframeRequired:
+        return Response(
+            content=json.dumps({"status": "keyframe_required", "rig_id": frame["rig_id"]}),
+            status_code=409,
+            media_type="application/json",
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        rig_id, ts = validate_heartbeat(data)
+    except ValueError as e:
+        HEARTBEATS_REJECTED.inc(reason="invalid")
+        delta_decoder.forget(data["rig_id"])
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    enqueue_heartbeats([(rig_id, ts, data)])
     
-    # Insert heartbeat
-    cursor.execute("""
-        INSERT INTO heartbeats (rig_id, timestamp, cpu_percent, memory_percent, disk_percent, data)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (rig_id, timestamp, data.get("cpu_percent"), data.get("memory_percent"), 
-          data.get("disk_percent"), json.dumps(data)))
+    return {
+        "status": "success",
+        "rig_id": rig_id,
+        "timestamp": format_timestamp(ts),
+        "ack": frame["seq"],
+        **agent_directives(rig_id, data),
+    }
+
+
+@app.post("/api/heartbeats/batch")
+async def receive_heartbeat_batch(request: Request, authorization: Optional[str] = Header(None)):
+    verify_api_key(authorization)
     
-    conn.commit()
-    conn.close()
+    with admission.slot():
+        return await accept_batch(request)
+
+
+async def accept_batch(request: Request):
+    heartbeats = decode_batch(await read_body(request))
+    
+    items = []
+    results = []
+    for index, data in enumerate(heartbeats):
+        try:
+            rig_id, ts = validate_heartbeat(data)
+        except ValueError as e:
+            HEARTBEATS_REJECTED.inc(reason="invalid")
+            results.append({"index": index, "status": "rejected", "error": str(e)})
+            continue
+        items.append((rig_id, ts, data))
+        results.append({"index": index, "status": "accepted", "rig_id": rig_id, "timestamp": format_timestamp(ts)})
+    
+    if items:
+        admission.check_rate(rig_id for rig_id, _, _ in items)
+        enqueue_heartbeats(items)
     
-    return {"status": "success", "rig_id": rig_id, "timestamp": timestamp}
+    return {
+        "status": "success",
+        "accepted": len(items),
+        "rejected": len(results) - len(items),
+        "results": results,
+    }
 
 
 @app.get("/api/rigs")
-def list_rigs():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+def list_rigs(
+    request: Request,
+    status: Optional[List[str]] = Query(None),
+    location: Optional[List[str]] = Query(None),
+    rack: Optional[List[str]] = Query(None),
+    ecu_type: Optional[List[str]] = Query(None),
+    capability: Optional[List[str]] = Query(None),
+    running: Optional[List[str]] = Query(None),
+    not_running: Optional[List[str]] = Query(None),
+    cpu_lt: Optional[float] = None,
+    cpu_gt: Optional[float] = None,
+    memory_lt: Optional[float] = None,
+    memory_gt: Optional[float] = None,
+    disk_lt: Optional[float] = None,
+    disk_gt: Optional[float] = None,
+    sort: str = "rig_id",
+    order: str = "asc",
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    if_none_match: Optional[str] = Header(None),
+):
+    if not request.query_params:
+        etag, body = rig_state.list_rigs()
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
     
-    cursor.execute("SELECT * FROM rigs")
-    rigs = [dict(row) for row in cursor.fetchall()]
+    if sort not in SORT_KEYS:
+        raise HTTPException(status_code=400, detail=f"Unknown sort key: {sort}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail=f"Unknown sort order: {order}")
     
-    conn.close()
-    return {"count": len(rigs), "rigs": rigs}
+    filters = {
+        "status": status,
+        "location": location,
+        "rack": rack,
+        "ecu_type": ecu_type,
+        "capability": capability,
+        "running": running,
+    }
+    bounds = {
+        "cpu_percent": (cpu_gt, cpu_lt),
+        "memory_percent": (memory_gt, memory_lt),
+        "disk_percent": (disk_gt, disk_lt),
+    }
+    try:
+        etag, result = rig_state.query_rigs(
+            {key: set(values) for key, values in filters.items() if values},
+            set(not_running or ()),
+            {metric: bound for metric, bound in bounds.items() if bound != (None, None)},
+            sort=sort,
+            descending=order == "desc",
+            cursor=cursor,
+            limit=limit,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=json.dumps(result), media_type="application/json", headers={"ETag": etag})
+
+
+@app.get("/api/fleet/summary")
+def fleet_summary():
+    return fleet.summary()
+
+
+@app.get("/api/fleet/utilization")
+def fleet_utilization(group_by: str = "location", window: int = Query(SLOTS, ge=1, le=SLOTS)):
+    if group_by not in GROUP_FIELDS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {', '.join(GROUP_FIELDS)}")
+    return {"group_by": group_by, "window_minutes": window, "groups": fleet.utilization(group_by, window)}
 
 
 @app.get("/api/rigs/{rig_id}")
-def get_rig(rig_id: str):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+def get_rig(rig_id: str, if_none_match: Optional[str] = Header(None)):
+    entry = rig_state.get_rig(rig_id)
+    if not entry:
+        raise HTTPException(status_code=404, detail="Rig not found")
     
-    cursor.execute("SELECT * FROM rigs WHERE rig_id = ?", (rig_id,))
-    rig = cursor.fetchone()
+    etag, rig, latest_heartbeat = entry
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    body = json.dumps({"rig": rig, "latest_heartbeat": latest_heartbeat})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+@app.get("/api/rigs/{rig_id}/metadata")
+def get_rig_metadata(rig_id: str):
+    if not rig_state.get_rig(rig_id):
+        raise HTTPException(status_code=404, detail="Rig not found")
     
-    if not rig:
-        conn.close()
+    versions = storage.metadata_versions(rig_id)
+    digest = storage.current_metadata_hash(rig_id)
+    current = next((version for version in versions if version["hash"] == digest), None)
+    return {
+        "rig_id": rig_id,
+        # Heartbeats past retention leave only the newest version to go by
+        "current": current or (versions[-1] if versions else None),
+        "versions": versions,
+    }
+
+
+def save_agent_config(scope: str, doc: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        validate_config(doc, MIN_AGENT_INTERVAL_S)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    version = storage.save_agent_config(scope, doc)
+    agent_configs.set(scope, version, doc)
+    return {"scope": scope, "version": version, "config": doc}
+
+
+@app.get("/api/config")
+def get_agent_configs():
+    return agent_configs.documents()
+
+
+@app.put("/api/config")
+def put_fleet_config(doc: Dict[str, Any], authorization: Optional[str] = Header(None)):
+    verify_api_key(authorization)
+    return save_agent_config(FLEET, doc)
+
+
+@app.get("/api/rigs/{rig_id}/config")
+def get_rig_config(rig_id: str):
+    version, doc = agent_configs.effective(rig_id)
+    return {
+        "rig_id": rig_id,
+        "config_version": version,
+        "config": doc,
+        "override": agent_configs.documents().get(rig_id),
+    }
+
+
+@app.put("/api/rigs/{rig_id}/config")
+def put_rig_config(rig_id: str, doc: Dict[str, Any], authorization: Optional[str] = Header(None)):
+    verify_api_key(authorization)
+    if rig_id == FLEET:
+        raise HTTPException(status_code=400, detail="Invalid rig_id")
+    return save_agent_config(rig_id, doc)
+
+
+@app.delete("/api/rigs/{rig_id}/config")
+def delete_rig_config(rig_id: str, authorization: Optional[str] = Header(None)):
+    verify_api_key(authorization)
+    if rig_id == FLEET:
+        raise HTTPException(status_code=400, detail="Invalid rig_id")
+    # Emptied rather than removed, so the version keeps counting up
+    return save_agent_config(rig_id, {})
+
+
+def parse_time_param(name: str, value: Optional[str], default: int) -> int:
+    if value is None or value == "":
+        return default
+    if value.isdigit():
+        return int(value)
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} timestamp")
+
+
+def parse_range(start: Optional[str], end: Optional[str]) -> Tuple[int, int]:
+    end_ts = parse_time_param("to", end, now_ms())
+    start_ts = parse_time_param("from", start, end_ts - METRICS_DEFAULT_RANGE_HOURS * 3600 * 1000)
+    if start_ts >= end_ts:
+        raise HTTPException(status_code=400, detail="'from' must be before 'to'")
+    return start_ts, end_ts
+
+
+@app.get("/api/rigs/{rig_id}/metrics")
+def get_rig_metrics(
+    rig_id: str,
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    resolution: str = "auto",
+    points: int = Query(METRICS_DEFAULT_POINTS, ge=1),
+):
+    if not rig_state.get_rig(rig_id):
         raise HTTPException(status_code=404, detail="Rig not found")
     
-    cursor.execute("""
-        SELECT * FROM heartbeats 
-        WHERE rig_id = ? 
-        ORDER BY timestamp DESC 
-        LIMIT 1
-    """, (rig_id,))
-    latest_heartbeat = cursor.fetchone()
+    start_ts, end_ts = parse_range(start, end)
     
-    conn.close()
+    if resolution == "auto":
+        resolution = rollups.choose_resolution(start_ts, end_ts, points)
+    elif resolution != "raw" and resolution not in rollups.RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown resolution: {resolution}")
     
     return {
-        "rig": dict(rig),
-        "latest_heartbeat": dict(latest_heartbeat) if latest_heartbeat else None
+        "rig_id": rig_id,
+        "from": format_timestamp(start_ts),
+        "to": format_timestamp(end_ts),
+        "resolution": resolution,
+        "points": storage.query_metrics(rig_id, start_ts, end_ts, resolution),
     }
 
 
-if __name__ == "__main__":
+@app.get("/api/rigs/{rig_id}/occupancy")
+def get_rig_occupancy(
+    rig_id: str,
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    limit: int = Query(1000, ge=0, le=10000),
+):
+    if not rig_state.get_rig(rig_id):
+        raise HTTPException(status_code=404, detail="Rig not found")
+    
+    start_ts, end_ts = parse_range(start, end)
+    intervals = storage.occupancy(rig_id, start_ts, end_ts)
+    busy_ms = idle_ms = 0
+    for interval in intervals:
+        ms = min(interval["end_ts"], end_ts) - max(interval["start_ts"], start_ts)
+        if interval["busy"]:
+            busy_ms += ms
+        else:
+            idle_ms += ms
+    return {
+        "rig_id": rig_id,
+        "from": format_timestamp(start_ts),
+        "to": format_timestamp(end_ts),
+        **occupancy.totals(busy_ms, idle_ms, end_ts - start_ts),
+        "count": len(intervals),
+        "intervals": intervals[:limit],
+    }
+
+
+@app.get("/api/fleet/occupancy")
+def fleet_occupancy(
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    location: Optional[List[str]] = Query(None),
+    rack: Optional[List[str]] = Query(None),
+    ecu_type: Optional[List[str]] = Query(None),
+    capability: Optional[List[str]] = Query(None),
+    group_by: Optional[str] = None,
+):
+    if group_by is not None and group_by not in GROUP_FIELDS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {', '.join(GROUP_FIELDS)}")
+    
+    start_ts, end_ts = parse_range(start, end)
+    span = end_ts - start_ts
+    filters = {"location": location, "rack": rack, "ecu_type": ecu_type, "capability": capability}
+    rig_ids = rig_state.matching({key: set(values) for key, values in filters.items() if values})
+    totals = storage.occupancy_totals(start_ts, end_ts)
+    
+    rigs = []
+    groups: Dict[Any, List[int]] = {}
+    busy_ms = idle_ms = 0
+    for rig_id in rig_ids:
+        entry = totals.get(rig_id, {"busy_ms": 0, "idle_ms": 0, "busy_intervals": 0})
+        rigs.append({
+            "rig_id": rig_id,
+            **occupancy.totals(entry["busy_ms"], entry["idle_ms"], span),
+            "busy_intervals": entry["busy_intervals"],
+        })
+        busy_ms += entry["busy_ms"]
+        idle_ms += entry["idle_ms"]
+        if group_by is not None:
+            group = groups.setdefault(rig_state.attributes(rig_id).get(group_by), [0, 0, 0])
+            group[0] += entry["busy_ms"]
+            group[1] += entry["idle_ms"]
+            group[2] += 1
+    
+    result = {
+        "from": format_timestamp(start_ts),
+        "to": format_timestamp(end_ts),
+        "count": len(rigs),
+        **occupancy.totals(busy_ms, idle_ms, span * len(rigs)),
+        "rigs": rigs,
+    }
+    if group_by is not None:
+        result["group_by"] = group_by
+        result["groups"] = [
+            {group_by: value, "rigs": count, **occupancy.totals(busy, idle, span * count)}
+            for value, (busy, idle, count) in sorted(groups.items(), key=lambda item: (item[0] is None, str(item[0])))
+        ]
+    return result
+
+
+EXPORT_COLUMNS = ("rig_id", "timestamp", "ts") + HOT_METRICS + ("data",)
+
+
+def encode_export(rows: Iterable[Dict[str, Any]], output_format: str) -> Iterator[str]:
+    if output_format == "ndjson":
+        for row in rows:
+            yield json.dumps(row, separators=(",", ":")) + "\n"
+        return
+    
+    # The full heartbeat goes into the data column as JSON; archived rows
+    # leave it empty
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        writer.writerow([
+            *(row[column] for column in EXPORT_COLUMNS[:-1]),
+            json.dumps(row["data"], separators=(",", ":")) if row["data"] is not None else "",
+        ])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def export_chunks(lines: Iterable[str], gzip: bool) -> Iterator[bytes]:
+    # Lines are gathered into chunks of roughly EXPORT_CHUNK_BYTES, so the
+    # response isn't written (or compressed) one row at a time
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if gzip else None
+    pending: List[str] = []
+    size = 0
+    for line in lines:
+        pending.append(line)
+        size += len(line)
+        if size < EXPORT_CHUNK_BYTES:
+            continue
+        chunk = "".join(pending).encode()
+        pending, size = [], 0
+        chunk = compressor.compress(chunk) if compressor else chunk
+        if chunk:
+            yield chunk
+    chunk = "".join(pending).encode()
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+@app.get("/api/export/heartbeats")
+def export_heartbeats(
+    rig_id: Optional[str] = None,
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    output_format: str = Query("ndjson", alias="format"),
+    gzip: bool = False,
+    include_archive: bool = False,
+):
+    if output_format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    if rig_id is not None and not rig_state.get_rig(rig_id):
+        raise HTTPException(status_code=404, detail="Rig not found")
+    if include_archive and rig_id is None:
+        # Archive files are read rig by rig
+        raise HTTPException(status_code=400, detail="include_archive requires rig_id")
+    
+    start_ts, end_ts = parse_range(start, end)
+    rows = storage.export_heartbeats(rig_id, start_ts, end_ts, include_archive)
+    filename = f"heartbeats.{output_format}" + (".gz" if gzip else "")
+    media_type = "application/x-ndjson" if output_format == "ndjson" else "text/csv"
+    return StreamingResponse(
+        export_chunks(encode_export(rows, output_format), gzip),
+        media_type="application/gzip" if gzip else media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.get("/api/events")
+def list_events(
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+):
+    until_ts = parse_time_param("until", until, now_ms() + 1)
+    since_ts = parse_time_param("since", since, until_ts - 24 * 3600 * 1000)
+    events = storage.query_events(None, since_ts, until_ts, limit)
+    return {"count": len(events), "events": events}
+
+
+@app.get("/api/rigs/{rig_id}/events")
+def list_rig_events(
+    rig_id: str,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+):
+    if not rig_state.get_rig(rig_id):
+        raise HTTPException(status_code=404, detail="Rig not found")
+    
+    until_ts = parse_time_param("until", until, now_ms() + 1)
+    since_ts = parse_time_param("since", since, until_ts - 24 * 3600 * 1000)
+    events = storage.query_events(rig_id, since_ts, until_ts, limit)
+    return {"rig_id": rig_id, "count": len(events), "events": events}
+
+
+async def stream_events(request: Request, subscriber):
+    try:
+        rigs = [
+            entry for entry in rig_state.snapshot()
+            if subscriber.matches(entry["rig"]["rig_id"], rig_state.attributes(entry["rig"]["rig_id"]))
+        ]
+        yield format_event("snapshot", {"count": len(rigs), "rigs": rigs})
+        
+        while not await request.is_disconnected():
+            messages = await subscriber.wait(STREAM_KEEPALIVE_S)
+            if messages is None:
+                yield b": keep-alive\n\n"
+                continue
+            for message in messages:
+                # Event dicts are shared by every subscriber, so leave them intact
+                data = {key: value for key, value in message.items() if key != "type"}
+                yield format_event(message["type"], data)
+            if subscriber.dropped:
+                yield format_event("reset", {"reason": "Subscriber fell too far behind"})
+                break
+    finally:
+        broker.unsubscribe(subscriber)
+
+
+@app.get("/api/stream")
+async def stream(
+    request: Request,
+    rig_id: Optional[List[str]] = Query(None),
+    location: Optional[List[str]] = Query(None),
+    rack: Optional[List[str]] = Query(None),
+    ecu_type: Optional[List[str]] = Query(None),
+    capability: Optional[List[str]] = Query(None),
+):
+    filters = {
+        "rig_id": rig_id,
+        "location": location,
+        "rack": rack,
+        "ecu_type": ecu_type,
+        "capability": capability,
+    }
+    try:
+        # Subscribe before the snapshot is taken so no update falls in between
+        subscriber = broker.subscribe({key: set(values) for key, values in filters.items() if values})
+    except SubscriberLimit as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+    
+    return StreamingResponse(
+        stream_events(request, subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def serve():
     print(f"Starting Vigilant Server on port {PORT}")
-    print(f"Database: {DB_PATH}")
+    print(f"Database: {DB_PATH} ({DB_SHARDS} shard{'s' if DB_SHARDS != 1 else ''})")
     print(f"API Key: {API_KEY}")
     print(f"\nSet API_KEY environment variable to change the API key")
     print(f"Example: API_KEY=mykey python server.py\n")
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    # Open event streams never end on their own, so bound how long shutdown
+    # waits for them before the lifespan flush runs
+    uvicorn.run(app, host="0.0.0.0", port=PORT, timeout_graceful_shutdown=STREAM_KEEPALIVE_S)
+
+
+def migrate(chunk_size: int, pause_ms: int, vacuum: bool):
+    # Safe to run next to a live server, rows move over in short transactions
+    print(f"Migrating {DB_PATH} to schema v{SCHEMA_VERSION}")
+    storage.open()
+    try:
+        migrated = storage.migrate_legacy_heartbeats(chunk_size, pause_ms / 1000)
+        print(f"Migrated {migrated} heartbeats")
+        if vacuum:
+            # Rewrites the whole file and blocks writers until it is done
+            print("Enabling incremental vacuum (VACUUM)")
+            storage.vacuum()
+    finally:
+        storage.close()
+
+
+def reshard_database(old_count: Optional[int], new_count: int):
+    if old_count is None:
+        layouts = existing_layouts(DB_PATH)
+        if len(layouts) != 1:
+            raise SystemExit(f"Found layouts {layouts} at {DB_PATH}, pass --from explicitly")
+        old_count = layouts[0]
+    print(f"Resharding {DB_PATH} from {old_count} to {new_count} shards, the server must be stopped")
+    reshard(DB_PATH, old_count, new_count)
+    print(f"Done, start the server with DB_SHARDS={new_count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vigilant Server")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("serve", help="Run the API server (default)")
+    migrate_parser = commands.add_parser("migrate", help="Convert legacy heartbeats to the current schema")
+    migrate_parser.add_argument("--chunk-size", type=int, default=5000)
+    migrate_parser.add_argument("--pause-ms", type=int, default=50)
+    migrate_parser.add_argument(
+        "--vacuum", action="store_true", help="Rebuild the file with incremental auto-vacuum"
+    )
+
+    reshard_parser = commands.add_parser("reshard", help="Redistribute rigs over a new number of shard files")
+    reshard_parser.add_argument("--from", dest="old_count", type=int, help="Current shard count (detected by default)")
+    reshard_parser.add_argument("--to", dest="new_count", type=int, required=True)
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate(args.chunk_size, args.pause_ms, args.vacuum)
+    elif args.command == "reshard":
+        reshard_database(args.old_count, args.new_count)
+    else:
+        serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+# shards.py
+
+import heapq
+import logging
+import re
+import sqlite3
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+import occupancy
+import rollups
+from storage import Heartbeat, Storage
+
+if TYPE_CHECKING:
+    from retention import Archive
+
+logger = logging.getLogger("vigilant")
+
+T = TypeVar("T")
+
+# Tables whose rows belong to exactly one rig and move with it on reshard
+RIG_TABLES = ("rigs", "rig_metadata", "heartbeats", "rig_events", "rig_occupancy") + tuple(
+    rollups.table_name(resolution) for resolution in rollups.RESOLUTIONS
+)
+
+# Fleet-wide tables, kept in the first shard
+GLOBAL_TABLES = ("agent_config",)
+
+RESHARD_CHUNK = 5000
+
+
+class LayoutMismatch(Exception):
+    pass
+
+
+def shard_index(rig_id: str, count: int) -> int:
+    # crc32 rather than hash(), which is salted per process
+    return zlib.crc32(rig_id.encode()) % count
+
+
+def shard_paths(path: Path, count: int) -> List[Path]:
+    # A single shard is the plain database file, so unsharded installs keep
+    # working without a reshard
+    if count == 1:
+        return [path]
+    return [path.with_name(f"{path.stem}.{i}-of-{count}{path.suffix}") for i in range(count)]
+
+
+def existing_layouts(path: Path) -> List[int]:
+    pattern = re.compile(rf"{re.escape(path.stem)}\.\d+-of-(\d+){re.escape(path.suffix)}$")
+    counts = {
+        int(match.group(1))
+        for candidate in path.parent.glob(f"{path.stem}.*-of-*{path.suffix}")
+        if (match := pattern.match(candidate.name))
+    }
+    if path.exists():
+        counts.add(1)
+    return sorted(counts)
+
+
+class ShardedStorage:
+    # Spreads rigs over several SQLite files by rig_id. Every shard has its own
+    # writer connection and write lock, so ingest for different shards commits
+    # in parallel. Per-rig calls go to one shard; fleet-wide reads run on all
+    # shards at once and are merged here.
+    def __init__(
+        self,
+        path: Path,
+        shards: int = 1,
+        readers: int = 4,
+        pragmas: Optional[Dict[str, Any]] = None,
+        archive: Optional["Archive"] = None,
+        occupancy_gap: int = occupancy.MAX_GAP_MS,
+    ) -> None:
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        self.path = Path(path)
+        self.archive = archive
+        self.shards = [
+            Storage(shard_path, readers=readers, pragmas=pragmas, archive=archive, occupancy_gap=occupancy_gap)
+            for shard_path in shard_paths(self.path, shards)
+        ]
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def shard_for(self, rig_id: str) -> Storage:
+        return self.shards[shard_index(rig_id, len(self.shards))]
+
+    def check_layout(self) -> None:
+        layouts = existing_layouts(self.path)
+        if layouts and len(self.shards) not in layouts:
+            raise LayoutMismatch(
+                f"{self.path} holds data for {', '.join(map(str, layouts))} shard(s), not "
+                f"{len(self.shards)}; run 'server.py reshard --from {layouts[-1]} --to {len(self.shards)}'"
+            )
+
+    def open(self) -> None:
+        self.check_layout()
+        for shard in self.shards:
+            shard.open()
+        if len(self.shards) > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=len(self.shards), thread_name_prefix="vigilant-shard"
+            )
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for shard in self.shards:
+            shard.close()
+
+    def _gather(self, func: Callable[[Storage], T]) -> List[T]:
+        # sqlite3 releases the GIL while a statement runs, so the shards
+        # really do scan in parallel
+        if self._executor is None:
+            return [func(shard) for shard in self.shards]
+        return list(self._executor.map(func, self.shards))
+
+    def _partition(self, items: Sequence[Tuple[Any, ...]]) -> Dict[int, List[Tuple[Any, ...]]]:
+        # Items are tuples that start with rig_id
+        parts: Dict[int, List[Tuple[Any, ...]]] = {}
+        for item in items:
+            parts.setdefault(shard_index(item[0], len(self.shards)), []).append(item)
+        return parts
+
+    def schema_version(self) -> int:
+        return min(self._gather(Storage.schema_version))
+
+    def migrate_legacy_heartbeats(self, chunk_size: int = 5000, pause: float = 0.05) -> int:
+        return sum(shard.migrate_legacy_heartbeats(chunk_size, pause) for shard in self.shards)
+
+    def vacuum(self) -> None:
+        for shard in self.shards:
+            shard.vacuum()
+
+    def incremental_vacuum(self, pages: int) -> None:
+        for shard in self.shards:
+            shard.incremental_vacuum(pages)
+
+    def store_heartbeats(self, items: List[Heartbeat]) -> List[Heartbeat]:
+        inserted: List[Heartbeat] = []
+        for index, part in self._partition(items).items():
+            inserted.extend(self.shards[index].store_heartbeats(part))
+        return inserted
+
+    def record_events(self, events: List[Tuple[str, int, str, Optional[str], Optional[str], Any]]) -> None:
+        for index, part in self._partition(events).items():
+            self.shards[index].record_events(part)
+
+    def query_metrics(self, rig_id: str, start: int, end: int, resolution: str) -> List[Dict[str, Any]]:
+        return self.shard_for(rig_id).query_metrics(rig_id, start, end, resolution)
+
+    def current_metadata_hash(self, rig_id: str) -> Optional[str]:
+        return self.shard_for(rig_id).current_metadata_hash(rig_id)
+
+    def metadata_versions(self, rig_id: str) -> List[Dict[str, Any]]:
+        return self.shard_for(rig_id).metadata_versions(rig_id)
+
+    def delete_heartbeats(self, rig_id: str, timestamps: Sequence[int]) -> int:
+        return self.shard_for(rig_id).delete_heartbeats(rig_id, timestamps)
+
+    def oldest_heartbeat_ts(self) -> Optional[int]:
+        oldest = [ts for ts in self._gather(Storage.oldest_heartbeat_ts) if ts is not None]
+        return min(oldest) if oldest else None
+
+    def heartbeat_columns(self, start: int, end: int, columns: Sequence[str]) -> List[Tuple[Any, ...]]:
+        # Each shard returns rows ordered by (rig_id, ts); keep that order
+        parts = self._gather(lambda shard: shard.heartbeat_columns(start, end, columns))
+        return list(heapq.merge(*parts, key=lambda row: (row[0], row[1])))
+
+    def export_heartbeats(
+        self, rig_id: Optional[str], start: int, end: int, include_archive: bool = False
+    ) -> Iterator[Dict[str, Any]]:
+        if rig_id is not None:
+            return self.shard_for(rig_id).export_heartbeats(rig_id, start, end, include_archive)
+        # One open cursor per shard, merged lazily, so memory stays flat
+        return heapq.merge(
+            *(shard.export_heartbeats(None, start, end) for shard in self.shards),
+            key=lambda row: (row["ts"], row["rig_id"]),
+        )
+
+    def query_events(
+        self, rig_id: Optional[str], since: int, until: int, limit: int
+    ) -> List[Dict[str, Any]]:
+        if rig_id is not None:
+            return self.shard_for(rig_id).query_events(rig_id, since, until, limit)
+        # Event ids are per shard, so the merge only orders by time
+        parts = self._gather(lambda shard: shard.query_events(None, since, until, limit))
+        merged = heapq.merge(*parts, key=lambda event: event["ts"], reverse=True)
+        return [event for _, event in zip(range(limit), merged)]
+
+    def occupancy(self, rig_id: str, start: int, end: int) -> List[Dict[str, Any]]:
+        return self.shard_for(rig_id).occupancy(rig_id, start, end)
+
+    def occupancy_totals(self, start: int, end: int) -> Dict[str, Dict[str, int]]:
+        # Every rig lives in one shard, so the parts never overlap
+        totals: Dict[str, Dict[str, int]] = {}
+        for part in self._gather(lambda shard: shard.occupancy_totals(start, end)):
+            totals.update(part)
+        return totals
+
+    def agent_configs(self) -> List[Tuple[str, int, Dict[str, Any]]]:
+        return self.shards[0].agent_configs()
+
+    def save_agent_config(self, scope: str, doc: Dict[str, Any]) -> int:
+        return self.shards[0].save_agent_config(scope, doc)
+
+    def list_rigs(self) -> List[Dict[str, Any]]:
+        return [rig for part in self._gather(Storage.list_rigs) for rig in part]
+
+    def latest_heartbeats(self) -> List[Dict[str, Any]]:
+        return [row for part in self._gather(Storage.latest_heartbeats) for row in part]
+
+
+def _copy_table(source: sqlite3.Connection, targets: List[Storage], table: str) -> int:
+    columns = [row[1] for row in source.execute(f"PRAGMA table_info({table})")]
+    if table == "rig_events":
+        # Autoincrement ids clash once several shards are merged
+        columns.remove("id")
+    insert = f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+    rig_column = columns.index("rig_id") if table in RIG_TABLES else None
+
+    copied = 0
+    cursor = source.execute(f"SELECT {', '.join(columns)} FROM {table}")
+    while True:
+        rows = cursor.fetchmany(RESHARD_CHUNK)
+        if not rows:
+            return copied
+        parts: Dict[int, List[Tuple[Any, ...]]] = {}
+        for row in rows:
+            index = 0 if rig_column is None else shard_index(row[rig_column], len(targets))
+            parts.setdefault(index, []).append(tuple(row))
+        for index, part in parts.items():
+            with targets[index].write() as conn:
+                conn.executemany(insert, part)
+        copied += len(rows)
+
+
+def reshard(path: Path, old_count: int, new_count: int, progress: Callable[[str], None] = print) -> None:
+    # Offline only: the server must be stopped, otherwise heartbeats written
+    # during the copy are lost when the old files are set aside
+    path = Path(path)
+    if old_count == new_count:
+        raise ValueError("Source and target shard counts are the same")
+    if old_count not in existing_layouts(path):
+        raise FileNotFoundError(f"No {old_count}-shard database found at {path}")
+    new_paths = shard_paths(path, new_count)
+    for new_path in new_paths:
+        if new_path.exists():
+            raise FileExistsError(f"{new_path} already exists")
+
+    sources = ShardedStorage(path, old_count, readers=1)
+    targets = ShardedStorage(path, new_count, readers=1)
+    for source in sources.shards:
+        source.open()
+        if source.has_table("heartbeats_v1"):
+            source.close()
+            raise RuntimeError(f"{source.path} still has legacy heartbeats; run 'server.py migrate' first")
+    try:
+        for target in targets.shards:
+            target.open()
+        for source in sources.shards:
+            with source.read() as conn:
+                for table in RIG_TABLES + GLOBAL_TABLES:
+                    copied = _copy_table(conn, targets.shards, table)
+                    progress(f"{source.path.name}: copied {copied} rows from {table}")
+    finally:
+        targets.close()
+        sources.close()
+
+    # Kept rather than deleted until someone has checked the new shards. The
+    # read-only connections close last and leave the WAL behind, so fold it
+    # back into the main file before that is renamed away from it.
+    for old_path in shard_paths(path, old_count):
+        conn = sqlite3.connect(old_path)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            conn.close()
+        old_path.rename(old_path.with_name(old_path.name + ".pre-reshard"))
+        progress(f"Moved {old_path.name} to {old_path.name}.pre-reshard")
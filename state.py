@@ -0,0 +1,352 @@
+# state.py
+
+import base64
+import bisect
+import heapq
+import json
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from occupancy import running_processes
+from storage import HOT_METRICS, Heartbeat, format_timestamp, heartbeat_row
+
+# Inventory fields with an inverted index, matched against the rig row or the
+# latest heartbeat
+INDEXED_FIELDS = ("status", "location", "rack", "ecu_type")
+
+# Multi-valued indexes where a query has to match every requested value
+ALL_OF_FIELDS = ("capability", "running")
+
+SORT_KEYS = ("rig_id", "last_seen") + HOT_METRICS
+
+# (field, value) -> rig_ids
+IndexKey = Tuple[str, str]
+
+
+class RigState:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._rigs: Dict[str, Dict[str, Any]] = {}
+        self._latest: Dict[str, Dict[str, Any]] = {}
+        self._rig_versions: Dict[str, int] = {}
+        self._version = 0
+        self._list_body: Optional[bytes] = None
+        self._index: Dict[IndexKey, Set[str]] = {}
+        self._index_keys: Dict[str, Set[IndexKey]] = {}
+        # rig_ids in sort order, for paging through the unfiltered inventory
+        self._order: List[str] = []
+        # Distinguishes ETags handed out before a restart
+        self._epoch = format(int(time.time() * 1000), "x")
+
+    def __len__(self) -> int:
+        return len(self._rigs)
+
+    def etag(self, version: int, variant: Optional[str] = None) -> str:
+        if variant:
+            return f'"{self._epoch}-{version}-{variant}"'
+        return f'"{self._epoch}-{version}"'
+
+    def _reindex(self, rig_id: str) -> None:
+        rig = self._rigs[rig_id]
+        latest = self._latest.get(rig_id)
+        keys = index_keys(rig, latest["data"] if latest else {})
+
+        old_keys = self._index_keys.get(rig_id, set())
+        for key in old_keys - keys:
+            rig_ids = self._index[key]
+            rig_ids.discard(rig_id)
+            if not rig_ids:
+                del self._index[key]
+        for key in keys - old_keys:
+            self._index.setdefault(key, set()).add(rig_id)
+        self._index_keys[rig_id] = keys
+
+    def load(self, rigs: List[Dict[str, Any]], latest: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._rigs = {rig["rig_id"]: rig for rig in rigs}
+            self._latest = {heartbeat["rig_id"]: heartbeat for heartbeat in latest}
+            self._version += 1
+            self._rig_versions = dict.fromkeys(self._rigs, self._version)
+            self._list_body = None
+
+            self._index = {}
+            self._index_keys = {}
+            self._order = sorted(self._rigs)
+            for rig_id in self._order:
+                self._reindex(rig_id)
+
+    def apply_heartbeats(self, items: List[Heartbeat]) -> List[Dict[str, Any]]:
+        # Returns what changed per rig, for live subscribers
+        newest: Dict[str, Heartbeat] = {}
+        for item in items:
+            rig_id, ts, _ = item
+            if rig_id not in newest or ts >= newest[rig_id][1]:
+                newest[rig_id] = item
+
+        changes = []
+        with self._lock:
+            self._version += 1
+            for rig_id, (_, ts, data) in newest.items():
+                timestamp = format_timestamp(ts)
+                rig = self._rigs.get(rig_id)
+                if rig is None:
+                    rig = self._rigs[rig_id] = {
+                        "rig_id": rig_id,
+                        "hostname": data.get("hostname"),
+                        "ip_address": data.get("ip_address"),
+                        "first_seen": timestamp,
+                        "last_seen": timestamp,
+                        "status": "online",
+                    }
+                    bisect.insort(self._order, rig_id)
+                elif timestamp >= (rig["last_seen"] or ""):
+                    # Copy on write so snapshots handed to readers never change
+                    rig = self._rigs[rig_id] = {
+                        **rig,
+                        "hostname": data.get("hostname"),
+                        "ip_address": data.get("ip_address"),
+                        "last_seen": timestamp,
+                    }
+
+                latest = self._latest.get(rig_id)
+                if latest is None or ts >= latest["ts"]:
+                    self._latest[rig_id] = heartbeat_row(rig_id, ts, data)
+                    changes.append(diff_heartbeat(rig, ts, latest["data"] if latest else {}, data))
+                self._rig_versions[rig_id] = self._version
+                self._reindex(rig_id)
+            self._list_body = None
+        return changes
+
+    def set_status(self, statuses: Dict[str, str]) -> None:
+        with self._lock:
+            self._version += 1
+            for rig_id, status in statuses.items():
+                rig = self._rigs.get(rig_id)
+                if rig is None or rig["status"] == status:
+                    continue
+                self._rigs[rig_id] = {**rig, "status": status}
+                self._rig_versions[rig_id] = self._version
+                self._reindex(rig_id)
+            self._list_body = None
+
+    def list_rigs(self) -> Tuple[str, bytes]:
+        with self._lock:
+            if self._list_body is None:
+                rigs = list(self._rigs.values())
+                self._list_body = json.dumps({"count": len(rigs), "rigs": rigs}).encode()
+            return self.etag(self._version), self._list_body
+
+    def query_rigs(
+        self,
+        filters: Dict[str, Set[str]],
+        not_running: Set[str],
+        thresholds: Dict[str, Tuple[Optional[float], Optional[float]]],
+        sort: str = "rig_id",
+        descending: bool = False,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+    ) -> Tuple[str, Dict[str, Any]]:
+        # filters map an indexed field to the values it may take; thresholds
+        # map a hot metric to exclusive (above, below) bounds
+        after = decode_cursor(cursor, sort, descending) if cursor else None
+        variant = format(zlib.crc32(json.dumps(
+            [sorted((k, sorted(v)) for k, v in filters.items()), sorted(not_running),
+             sorted(thresholds.items()), sort, descending, cursor, limit]
+        ).encode()), "x")
+
+        with self._lock:
+            candidates: Optional[Set[str]] = None
+            for rig_ids in sorted(self._matching_sets(filters), key=len):
+                candidates = set(rig_ids) if candidates is None else candidates & rig_ids
+                if not candidates:
+                    break
+            if candidates is not None:
+                for name in not_running:
+                    candidates -= self._index.get(("running", name), set())
+
+            def wanted(rig_id: str) -> bool:
+                if candidates is None and any(
+                    rig_id in self._index.get(("running", name), ()) for name in not_running
+                ):
+                    return False
+                if thresholds:
+                    latest = self._latest.get(rig_id) or {}
+                    for metric, (above, below) in thresholds.items():
+                        value = _number(latest.get(metric))
+                        if value is None:
+                            return False
+                        if above is not None and value <= above:
+                            return False
+                        if below is not None and value >= below:
+                            return False
+                return True
+
+            def key(rig_id: str) -> Tuple[Any, ...]:
+                return sort_key(self._rigs[rig_id], self._latest.get(rig_id), sort, descending)
+
+            if candidates is None and sort == "rig_id" and not descending:
+                # Walk the sorted inventory from the cursor, so paging costs
+                # O(limit) rather than a sort of the whole fleet
+                start = bisect.bisect_right(self._order, after[-1]) if after else 0
+                page = []
+                for rig_id in self._order[start:]:
+                    if wanted(rig_id):
+                        page.append(rig_id)
+                        if len(page) > limit:
+                            break
+            else:
+                pool: Iterable[str] = self._order if candidates is None else candidates
+                if after is not None:
+                    pool = (
+                        rig_id for rig_id in pool
+                        if (key(rig_id) < after if descending else key(rig_id) > after)
+                    )
+                pool = (rig_id for rig_id in pool if wanted(rig_id))
+                select = heapq.nlargest if descending else heapq.nsmallest
+                page = select(limit + 1, pool, key=key)
+
+            next_cursor = encode_cursor(key(page[limit - 1]), sort, descending) if len(page) > limit else None
+            rigs = [self._rigs[rig_id] for rig_id in page[:limit]]
+            etag = self.etag(self._version, variant)
+        return etag, {"count": len(rigs), "rigs": rigs, "next_cursor": next_cursor}
+
+    def matching(self, filters: Dict[str, Set[str]]) -> List[str]:
+        # rig_ids passing every filter, in rig_id order
+        with self._lock:
+            rig_ids = set(self._order)
+            for matching in self._matching_sets(filters):
+                rig_ids &= matching
+            return sorted(rig_ids)
+
+    def _matching_sets(self, filters: Dict[str, Set[str]]) -> List[Set[str]]:
+        sets = []
+        for field, values in filters.items():
+            if field in ALL_OF_FIELDS:
+                sets += [self._index.get((field, value), set()) for value in values]
+            else:
+                union: Set[str] = set()
+                for value in values:
+                    union |= self._index.get((field, value), set())
+                sets.append(union)
+        return sets
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                {"rig": rig, "latest_heartbeat": self._latest.get(rig_id)}
+                for rig_id, rig in self._rigs.items()
+            ]
+
+    def attributes(self, rig_id: str) -> Dict[str, Any]:
+        # Latest merged heartbeat fields, used to match subscriber filters
+        latest = self._latest.get(rig_id)
+        return latest["data"] if latest else {}
+
+    def get_rig(
+        self, rig_id: str
+    ) -> Optional[Tuple[str, Dict[str, Any], Optional[Dict[str, Any]]]]:
+        with self._lock:
+            rig = self._rigs.get(rig_id)
+            if rig is None:
+                return None
+            return self.etag(self._rig_versions[rig_id]), rig, self._latest.get(rig_id)
+
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return float(value)
+
+
+def _index_value(value: Any) -> Optional[str]:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (str, int, float)):
+        return str(value)
+    return None
+
+
+def index_keys(rig: Dict[str, Any], data: Dict[str, Any]) -> Set[IndexKey]:
+    keys = set()
+    for field in INDEXED_FIELDS:
+        value = _index_value(rig[field] if field in rig else data.get(field))
+        if value is not None:
+            keys.add((field, value))
+
+    capabilities = data.get("capabilities")
+    if isinstance(capabilities, list):
+        keys.update(
+            ("capability", value)
+            for value in map(_index_value, capabilities) if value is not None
+        )
+    keys.update(("running", name) for name in running_processes(data))
+    return keys
+
+
+def sort_key(
+    rig: Dict[str, Any], latest: Optional[Dict[str, Any]], sort: str, descending: bool
+) -> Tuple[Any, ...]:
+    if sort == "rig_id":
+        return (rig["rig_id"],)
+    if sort == "last_seen":
+        value, fill = rig["last_seen"], ""
+    else:
+        value, fill = _number((latest or {}).get(sort)), 0.0
+    # Rigs without a value sort last in either direction
+    missing = value is None
+    return (missing != descending, fill if missing else value, rig["rig_id"])
+
+
+def encode_cursor(key: Tuple[Any, ...], sort: str, descending: bool) -> str:
+    raw = json.dumps({"sort": sort, "desc": descending, "key": list(key)})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str, descending: bool) -> Tuple[Any, ...]:
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        key = tuple(raw["key"])
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Invalid cursor")
+    if raw.get("sort") != sort or raw.get("desc") != descending:
+        raise ValueError("Cursor was issued for a different sort order")
+
+    if sort == "rig_id":
+        valid = len(key) == 1 and isinstance(key[0], str)
+    else:
+        fill_type = str if sort == "last_seen" else (int, float)
+        valid = (
+            len(key) == 3 and isinstance(key[0], bool)
+            and isinstance(key[1], fill_type) and not isinstance(key[1], bool)
+            and isinstance(key[2], str)
+        )
+    if not valid:
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def diff_heartbeat(
+    rig: Dict[str, Any], ts: int, old: Dict[str, Any], new: Dict[str, Any]
+) -> Dict[str, Any]:
+    changed = {key: value for key, value in new.items() if old.get(key) != value}
+    changed.update((key, None) for key in old if key not in new)
+
+    old_running = set(running_processes(old))
+    new_running = set(running_processes(new))
+    return {
+        "rig_id": rig["rig_id"],
+        "timestamp": format_timestamp(ts),
+        "rig": rig,
+        "changes": changed,
+        "started": sorted(new_running - old_running),
+        "stopped": sorted(old_running - new_running),
+    }
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
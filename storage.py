@@ -0,0 +1,838 @@
+# storage.py
+
+import hashlib
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+import occupancy
+import rollups
+from metrics import Histogram
+
+if TYPE_CHECKING:
+    from retention import Archive
+
+logger = logging.getLogger("vigilant")
+
+# (rig_id, ts, data) as produced by the API handlers, ts in epoch milliseconds
+Heartbeat = Tuple[str, int, Dict[str, Any]]
+
+SCHEMA_VERSION = 8
+
+DB_CONNECT_SECONDS = Histogram(
+    "vigilant_db_connect_seconds", "Time to open and configure a connection", labels=("role",)
+)
+DB_WAIT_SECONDS = Histogram(
+    "vigilant_db_wait_seconds", "Time waiting for a pooled reader or the write lock", labels=("role",)
+)
+DB_QUERY_SECONDS = Histogram("vigilant_db_query_seconds", "Time a reader connection is held")
+DB_COMMIT_SECONDS = Histogram("vigilant_db_commit_seconds", "Time spent in COMMIT")
+
+# Metrics stored as typed columns next to the raw payload
+HOT_METRICS = (
+    "cpu_percent",
+    "memory_percent",
+    "disk_percent",
+    "memory_used_gb",
+    "disk_free_gb",
+    "uptime_hours",
+)
+
+# Fields that rarely change; stored once per version in rig_metadata
+# instead of in every heartbeat row
+STATIC_FIELDS = (
+    "hostname",
+    "ip_address",
+    "os",
+    "agent_version",
+    "location",
+    "rack",
+    "capabilities",
+    "ecu_type",
+    "contact",
+    "metadata",
+)
+
+# Rebuilt from the key columns when a heartbeat is read back
+KEY_FIELDS = ("rig_id", "timestamp")
+
+DEFAULT_PRAGMAS = {
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -20000,
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+}
+
+# Statements are kept as module constants so sqlite3's per-connection
+# statement cache hands back the same prepared statement on every call
+UPSERT_RIG_SQL = """
+    INSERT INTO rigs (rig_id, hostname, ip_address, first_seen, last_seen, status)
+    VALUES (?, ?, ?, ?, ?, 'online')
+    ON CONFLICT(rig_id) DO UPDATE SET
+        last_seen = MAX(last_seen, excluded.last_seen),
+        hostname = CASE WHEN excluded.last_seen >= last_seen
+            THEN excluded.hostname ELSE hostname END,
+        ip_address = CASE WHEN excluded.last_seen >= last_seen
+            THEN excluded.ip_address ELSE ip_address END
+"""
+
+# Re-sent heartbeats share (rig_id, ts) and are ignored rather than duplicated
+INSERT_HEARTBEAT_SQL = f"""
+    INSERT OR IGNORE INTO heartbeats
+        (rig_id, ts, {", ".join(HOT_METRICS)}, metadata_hash, data, created_at)
+    VALUES (?, ?, {", ".join("?" for _ in HOT_METRICS)}, ?, ?, ?)
+"""
+
+INSERT_METADATA_SQL = """
+    INSERT OR IGNORE INTO rig_metadata (rig_id, hash, first_seen, data)
+    VALUES (?, ?, ?, ?)
+"""
+
+SELECT_METADATA_SQL = "SELECT data FROM rig_metadata WHERE rig_id = ? AND hash = ?"
+
+SELECT_METADATA_VERSIONS_SQL = """
+    SELECT hash, first_seen, data FROM rig_metadata
+    WHERE rig_id = ?
+    ORDER BY first_seen
+"""
+
+SELECT_CURRENT_METADATA_SQL = """
+    SELECT metadata_hash FROM heartbeats
+    WHERE rig_id = ?
+    ORDER BY ts DESC
+    LIMIT 1
+"""
+
+SELECT_HEARTBEAT_EXISTS_SQL = "SELECT 1 FROM heartbeats WHERE rig_id = ? AND ts = ?"
+
+ROLLUP_UPSERT_SQL = {resolution: rollups.upsert_sql(resolution) for resolution in rollups.RESOLUTIONS}
+
+SELECT_RAW_METRICS_SQL = f"""
+    SELECT ts, {", ".join(rollups.ROLLUP_METRICS.values())} FROM heartbeats
+    WHERE rig_id = ? AND ts >= ? AND ts < ?
+    ORDER BY ts
+"""
+
+SELECT_ROLLUP_SQL = {
+    resolution: f"""
+        SELECT * FROM {rollups.table_name(resolution)}
+        WHERE rig_id = ? AND bucket >= ? AND bucket < ?
+        ORDER BY bucket
+    """
+    for resolution in rollups.RESOLUTIONS
+}
+
+SELECT_OLDEST_TS_SQL = "SELECT MIN(ts) FROM heartbeats"
+
+# Both walk an index in the order given, so SQLite never has to sort (and
+# buffer) the whole range before the first row comes back
+SELECT_EXPORT_SQL = f"""
+    SELECT rig_id, ts, {", ".join(HOT_METRICS)}, metadata_hash, data FROM heartbeats
+    WHERE ts >= ? AND ts < ?
+    ORDER BY ts, rig_id
+"""
+
+SELECT_RIG_EXPORT_SQL = f"""
+    SELECT rig_id, ts, {", ".join(HOT_METRICS)}, metadata_hash, data FROM heartbeats
+    WHERE rig_id = ? AND ts >= ? AND ts < ?
+    ORDER BY ts
+"""
+
+SELECT_RIG_OLDEST_TS_SQL = "SELECT MIN(ts) FROM heartbeats WHERE rig_id = ? AND ts >= ? AND ts < ?"
+
+EXPORT_CHUNK = 1000
+
+DELETE_HEARTBEAT_SQL = "DELETE FROM heartbeats WHERE rig_id = ? AND ts = ?"
+
+INSERT_EVENT_SQL = """
+    INSERT INTO rig_events (rig_id, ts, event, old_status, new_status, detail)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+SELECT_AGENT_CONFIGS_SQL = "SELECT scope, version, data FROM agent_config"
+
+UPSERT_AGENT_CONFIG_SQL = """
+    INSERT INTO agent_config (scope, version, data, updated_at)
+    VALUES (?, 1, ?, ?)
+    ON CONFLICT(scope) DO UPDATE SET
+        version = version + 1, data = excluded.data, updated_at = excluded.updated_at
+"""
+
+SELECT_AGENT_CONFIG_VERSION_SQL = "SELECT version FROM agent_config WHERE scope = ?"
+
+UPDATE_RIG_STATUS_SQL = "UPDATE rigs SET status = ? WHERE rig_id = ?"
+
+SELECT_RIGS_SQL = "SELECT * FROM rigs"
+
+SELECT_LATEST_HEARTBEATS_SQL = f"""
+    SELECT h.rig_id, h.ts, {", ".join("h." + m for m in HOT_METRICS)}, h.metadata_hash, h.data
+    FROM rigs r
+    JOIN heartbeats h ON h.rig_id = r.rig_id AND h.ts = (
+        SELECT MAX(ts) FROM heartbeats WHERE rig_id = r.rig_id
+    )
+"""
+
+SELECT_LEGACY_LATEST_HEARTBEAT_SQL = """
+    SELECT rig_id, timestamp, data FROM heartbeats_v1
+    WHERE rig_id = ?
+    ORDER BY timestamp DESC
+    LIMIT 1
+"""
+
+SELECT_LEGACY_CHUNK_SQL = """
+    SELECT id, rig_id, timestamp, data, created_at FROM heartbeats_v1
+    ORDER BY id
+    LIMIT ?
+"""
+
+
+def parse_timestamp(value: Any) -> int:
+    # ISO 8601 strings as sent by the agent, or integer epoch milliseconds
+    if isinstance(value, bool):
+        raise ValueError("Invalid timestamp")
+    if isinstance(value, int):
+        return value
+    if not isinstance(value, str):
+        raise ValueError("Invalid timestamp")
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def try_parse_timestamp(value: Any) -> Optional[int]:
+    try:
+        return parse_timestamp(value)
+    except (ValueError, OverflowError):
+        return None
+
+
+def parse_legacy_heartbeat(
+    timestamp: Any, data: Optional[str], created_at: Any
+) -> Optional[Tuple[int, Dict[str, Any], int]]:
+    # The v1 API stored whatever timestamp string a client sent; fall back to
+    # when the row was written, and give up only if neither parses
+    created = try_parse_timestamp(created_at) if created_at else None
+    ts = try_parse_timestamp(timestamp)
+    if ts is None:
+        ts = created
+    try:
+        payload = json.loads(data or "{}")
+    except ValueError:
+        return None
+    if ts is None or not isinstance(payload, dict):
+        return None
+    return ts, payload, created if created is not None else now_ms()
+
+
+def format_timestamp(ts: int) -> str:
+    return datetime.fromtimestamp(ts / 1000, timezone.utc).isoformat(timespec="milliseconds")
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def split_heartbeat(data: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    static = {}
+    dynamic = {}
+    for key, value in data.items():
+        if key in STATIC_FIELDS:
+            static[key] = value
+        elif key not in KEY_FIELDS and key not in HOT_METRICS:
+            dynamic[key] = value
+    return static, dynamic
+
+
+def metadata_hash(static: Dict[str, Any]) -> str:
+    canonical = json.dumps(static, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode()).hexdigest()[:16]
+
+
+def heartbeat_row(rig_id: str, ts: int, data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "rig_id": rig_id,
+        "timestamp": format_timestamp(ts),
+        "ts": ts,
+        **{metric: data.get(metric) for metric in HOT_METRICS},
+        "data": data,
+    }
+
+
+class Storage:
+    def __init__(
+        self,
+        path: Path,
+        readers: int = 4,
+        pragmas: Optional[Dict[str, Any]] = None,
+        cached_statements: int = 256,
+        archive: Optional["Archive"] = None,
+        occupancy_gap: int = occupancy.MAX_GAP_MS,
+    ) -> None:
+        self.path = Path(path)
+        self.archive = archive
+        self.occupancy_gap = occupancy_gap
+        self.readers = readers
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        self.cached_statements = cached_statements
+
+        self._writer: Optional[sqlite3.Connection] = None
+        self._metadata_cache: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # rig_id -> its latest occupancy interval, as committed
+        self._open_intervals: Dict[str, occupancy.Interval] = {}
+        self._write_lock = threading.Lock()
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+
+    def _apply_pragmas(self, conn: sqlite3.Connection) -> None:
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+
+    def _connect_writer(self) -> sqlite3.Connection:
+        started = time.perf_counter()
+        # Autocommit mode, transactions are opened explicitly in write()
+        conn = sqlite3.connect(
+            self.path,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        # Only takes effect on a brand new file, existing databases need
+        # 'server.py migrate --vacuum' to switch over
+        if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        self._apply_pragmas(conn)
+        DB_CONNECT_SECONDS.observe(time.perf_counter() - started, role="writer")
+        return conn
+
+    def _connect_reader(self) -> sqlite3.Connection:
+        started = time.perf_counter()
+        conn = sqlite3.connect(
+            f"{self.path.resolve().as_uri()}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        conn.row_factory = sqlite3.Row
+        self._apply_pragmas(conn)
+        conn.execute("PRAGMA query_only = ON")
+        DB_CONNECT_SECONDS.observe(time.perf_counter() - started, role="reader")
+        return conn
+
+    def open(self) -> None:
+        self._writer = self._connect_writer()
+        self.init_schema()
+        for _ in range(self.readers):
+            self._pool.put(self._connect_reader())
+
+    def close(self) -> None:
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    @contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        started = time.perf_counter()
+        conn = self._pool.get()
+        acquired = time.perf_counter()
+        DB_WAIT_SECONDS.observe(acquired - started, role="reader")
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+            DB_QUERY_SECONDS.observe(time.perf_counter() - acquired)
+
+    @contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        started = time.perf_counter()
+        with self._write_lock:
+            DB_WAIT_SECONDS.observe(time.perf_counter() - started, role="writer")
+            conn = self._writer
+            if conn is None:
+                raise sqlite3.ProgrammingError("Storage is closed")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            with DB_COMMIT_SECONDS.time():
+                conn.execute("COMMIT")
+
+    def schema_version(self) -> int:
+        with self._write_lock:
+            return self._writer.execute("PRAGMA user_version").fetchone()[0]
+
+    def has_table(self, name: str) -> bool:
+        with self.read() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+            ).fetchone()
+        return row is not None
+
+    def init_schema(self) -> None:
+        migrations = {
+            1: self._create_v1,
+            2: self._migrate_v2,
+            3: self._migrate_v3,
+            4: self._migrate_v4,
+            5: self._migrate_v5,
+            6: self._migrate_v6,
+            7: self._migrate_v7,
+            8: self._migrate_v8,
+        }
+        version = self.schema_version()
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            with self.write() as conn:
+                migrations[target](conn)
+                conn.execute(f"PRAGMA user_version = {target}")
+
+    def _create_v1(self, conn: sqlite3.Connection) -> None:
+        # Rigs table
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rigs (
+                rig_id TEXT PRIMARY KEY,
+                hostname TEXT,
+                ip_address TEXT,
+                first_seen TEXT,
+                last_seen TEXT,
+                status TEXT DEFAULT 'offline'
+            )
+        """)
+
+        # Heartbeats table
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS heartbeats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                rig_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                cpu_percent REAL,
+                memory_percent REAL,
+                disk_percent REAL,
+                data TEXT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (rig_id) REFERENCES rigs(rig_id)
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_heartbeats_rig_timestamp
+            ON heartbeats (rig_id, timestamp)
+        """)
+
+    def _migrate_v2(self, conn: sqlite3.Connection) -> None:
+        # The v1 table is only renamed here; rows are copied over in chunks by
+        # migrate_legacy_heartbeats() while the server keeps running
+        conn.execute("ALTER TABLE heartbeats RENAME TO heartbeats_v1")
+        conn.execute(f"""
+            CREATE TABLE heartbeats (
+                rig_id TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                {" ".join(metric + " REAL," for metric in HOT_METRICS)}
+                data TEXT,
+                created_at INTEGER NOT NULL,
+                PRIMARY KEY (rig_id, ts)
+            ) WITHOUT ROWID
+        """)
+        if conn.execute("SELECT 1 FROM heartbeats_v1 LIMIT 1").fetchone() is None:
+            conn.execute("DROP TABLE heartbeats_v1")
+
+    def _migrate_v3(self, conn: sqlite3.Connection) -> None:
+        for resolution in rollups.RESOLUTIONS:
+            conn.execute(rollups.create_table_sql(resolution))
+            conn.execute(rollups.backfill_sql(resolution))
+
+    def _migrate_v4(self, conn: sqlite3.Connection) -> None:
+        # Lets retention find the oldest day without scanning every rig
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_heartbeats_ts ON heartbeats (ts)")
+
+    def _migrate_v5(self, conn: sqlite3.Connection) -> None:
+        # Each distinct static block is stored once per rig; existing rows keep
+        # their full payload and a NULL metadata_hash
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rig_metadata (
+                rig_id TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                first_seen INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (rig_id, hash)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("ALTER TABLE heartbeats ADD COLUMN metadata_hash TEXT")
+
+    def _migrate_v6(self, conn: sqlite3.Connection) -> None:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rig_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                rig_id TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                event TEXT NOT NULL,
+                old_status TEXT,
+                new_status TEXT,
+                detail TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rig_events_rig_ts ON rig_events (rig_id, ts)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rig_events_ts ON rig_events (ts)")
+
+    def _migrate_v7(self, conn: sqlite3.Connection) -> None:
+        # Remote agent config, scope is '*' for the fleet or a rig_id. Rows are
+        # never deleted, only emptied, so a scope's version never repeats.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS agent_config (
+                scope TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                updated_at INTEGER NOT NULL
+            )
+        """)
+
+    def _migrate_v8(self, conn: sqlite3.Connection) -> None:
+        # Busy/idle intervals, derived from heartbeats as they are stored and
+        # kept after the heartbeats themselves expire
+        conn.execute(occupancy.CREATE_TABLE_SQL)
+        conn.execute(occupancy.CREATE_INDEX_SQL)
+        self._open_intervals = occupancy.backfill(conn, self.occupancy_gap)
+
+    def migrate_legacy_heartbeats(self, chunk_size: int = 5000, pause: float = 0.05) -> int:
+        migrated = 0
+        while self.has_table("heartbeats_v1"):
+            with self.write() as conn:
+                rows = conn.execute(SELECT_LEGACY_CHUNK_SQL, (chunk_size,)).fetchall()
+                if not rows:
+                    conn.execute("DROP TABLE heartbeats_v1")
+                    # Migrated rows are older than anything ingest has seen,
+                    # so they never went through occupancy.advance
+                    backfilled = occupancy.backfill(conn, self.occupancy_gap)
+                    logger.info(f"Derived occupancy intervals for {len(backfilled)} rigs from migrated heartbeats")
+                    break
+
+                parsed = []
+                for row_id, rig_id, timestamp, data, created_at in rows:
+                    heartbeat = parse_legacy_heartbeat(timestamp, data, created_at)
+                    if heartbeat is None:
+                        logger.warning(f"Skipping legacy heartbeat {row_id} from {rig_id}: unreadable timestamp or data")
+                        continue
+                    parsed.append((rig_id, *heartbeat))
+                _, new_metadata = self._insert_heartbeats(conn, parsed)
+                conn.execute("DELETE FROM heartbeats_v1 WHERE id <= ?", (rows[-1][0],))
+            self._metadata_cache.update(new_metadata)
+
+            migrated += len(parsed)
+            # Let the ingest writer in between chunks
+            time.sleep(pause)
+        return migrated
+
+    def _insert_heartbeats(
+        self, conn: sqlite3.Connection, rows: List[Tuple[str, int, Dict[str, Any], int]]
+    ) -> Tuple[List[Heartbeat], Dict[Tuple[str, str], Dict[str, Any]]]:
+        # Skip anything already stored (agent retries, replays) so rollups
+        # never count the same heartbeat twice
+        seen = set()
+        inserted: List[Heartbeat] = []
+        params = []
+        metadata_params = []
+        new_metadata: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        for rig_id, ts, data, created_at in rows:
+            if (rig_id, ts) in seen:
+                continue
+            seen.add((rig_id, ts))
+            if conn.execute(SELECT_HEARTBEAT_EXISTS_SQL, (rig_id, ts)).fetchone():
+                continue
+
+            static, dynamic = split_heartbeat(data)
+            digest = metadata_hash(static)
+            if (rig_id, digest) not in self._metadata_cache and (rig_id, digest) not in new_metadata:
+                new_metadata[(rig_id, digest)] = static
+                metadata_params.append((rig_id, digest, ts, json.dumps(static)))
+
+            inserted.append((rig_id, ts, data))
+            params.append((
+                rig_id,
+                ts,
+                *(data.get(metric) for metric in HOT_METRICS),
+                digest,
+                json.dumps(dynamic, separators=(",", ":")),
+                created_at,
+            ))
+
+        conn.executemany(INSERT_METADATA_SQL, metadata_params)
+        conn.executemany(INSERT_HEARTBEAT_SQL, params)
+        for resolution, width in rollups.RESOLUTIONS.items():
+            conn.executemany(ROLLUP_UPSERT_SQL[resolution], rollups.aggregate(inserted, width))
+        return inserted, new_metadata
+
+    def store_heartbeats(self, items: List[Heartbeat]) -> List[Heartbeat]:
+        latest: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+        for rig_id, ts, data in items:
+            if rig_id not in latest or ts >= latest[rig_id][0]:
+                latest[rig_id] = (ts, data)
+
+        created_at = now_ms()
+        with self.write() as conn:
+            conn.executemany(UPSERT_RIG_SQL, [
+                (rig_id, data.get("hostname"), data.get("ip_address"),
+                 format_timestamp(ts), format_timestamp(ts))
+                for rig_id, (ts, data) in latest.items()
+            ])
+            inserted, new_metadata = self._insert_heartbeats(conn, [
+                (rig_id, ts, data, created_at) for rig_id, ts, data in items
+            ])
+            intervals = self._intervals(conn, {rig_id for rig_id, _, _ in inserted})
+            late = occupancy.late_starts(intervals, inserted)
+            rows = occupancy.advance(
+                intervals, [item for item in inserted if item[0] not in late], self.occupancy_gap
+            )
+            conn.executemany(occupancy.UPSERT_SQL, list(rows.values()))
+            # Outbox replays arrive after the live heartbeat that followed
+            # the outage; they are rebuilt into the intervals around them
+            for rig_id, since in late.items():
+                interval = occupancy.rebuild(conn, rig_id, since, self.occupancy_gap)
+                if interval is not None:
+                    intervals[rig_id] = interval
+        # Only remember metadata versions and intervals once they are committed
+        self._metadata_cache.update(new_metadata)
+        self._open_intervals.update(intervals)
+        return inserted
+
+    def _intervals(self, conn: sqlite3.Connection, rig_ids: Set[str]) -> Dict[str, occupancy.Interval]:
+        intervals = {}
+        for rig_id in rig_ids:
+            interval = self._open_intervals.get(rig_id)
+            if interval is None:
+                row = conn.execute(occupancy.SELECT_LAST_SQL, (rig_id,)).fetchone()
+                if row is None:
+                    continue
+                interval = (row[0], row[1], tuple(json.loads(row[2])))
+            intervals[rig_id] = interval
+        return intervals
+
+    def query_metrics(
+        self, rig_id: str, start: int, end: int, resolution: str
+    ) -> List[Dict[str, Any]]:
+        with self.read() as conn:
+            if resolution == "raw":
+                rows = conn.execute(SELECT_RAW_METRICS_SQL, (rig_id, start, end)).fetchall()
+                if self.archive is None:
+                    return [rollups.raw_point(row) for row in rows]
+
+                # Older raw rows live in the archive files, live rows win on overlap
+                merged = {row["ts"]: row for row in self.archive.read(rig_id, start, end)}
+                merged.update((row["ts"], row) for row in rows)
+                return [rollups.raw_point(merged[ts]) for ts in sorted(merged)]
+
+            width = rollups.RESOLUTIONS[resolution]
+            rows = conn.execute(SELECT_ROLLUP_SQL[resolution], (rig_id, start - start % width, end))
+            return [rollups.rollup_point(row) for row in rows]
+
+    def export_heartbeats(
+        self, rig_id: Optional[str], start: int, end: int, include_archive: bool = False
+    ) -> Iterator[Dict[str, Any]]:
+        # A connection of its own rather than one from the pool, which an
+        # export could hold for minutes. Under WAL the read never blocks
+        # ingest, though the WAL can't be checkpointed past it until it ends.
+        conn = self._connect_reader()
+        try:
+            if rig_id is None:
+                cursor = conn.execute(SELECT_EXPORT_SQL, (start, end))
+            else:
+                if include_archive and self.archive is not None:
+                    # Archived days hold only the metric columns; stop where
+                    # the live rows take over
+                    oldest = conn.execute(SELECT_RIG_OLDEST_TS_SQL, (rig_id, start, end)).fetchone()[0]
+                    for row in self.archive.read(rig_id, start, end if oldest is None else oldest):
+                        yield {**heartbeat_row(rig_id, row["ts"], row), "data": None, "archived": True}
+                cursor = conn.execute(SELECT_RIG_EXPORT_SQL, (rig_id, start, end))
+            while True:
+                rows = cursor.fetchmany(EXPORT_CHUNK)
+                if not rows:
+                    return
+                for row in rows:
+                    yield heartbeat_row(row["rig_id"], row["ts"], self.expand_heartbeat(conn, row))
+        finally:
+            conn.close()
+
+    def oldest_heartbeat_ts(self) -> Optional[int]:
+        with self.read() as conn:
+            return conn.execute(SELECT_OLDEST_TS_SQL).fetchone()[0]
+
+    def heartbeat_columns(
+        self, start: int, end: int, columns: Sequence[str]
+    ) -> List[Tuple[Any, ...]]:
+        with self.read() as conn:
+            rows = conn.execute(
+                f"SELECT rig_id, ts, {', '.join(columns)} FROM heartbeats "
+                "WHERE ts >= ? AND ts < ? ORDER BY rig_id, ts",
+                (start, end),
+            )
+            return [tuple(row) for row in rows]
+
+    def delete_heartbeats(self, rig_id: str, timestamps: Sequence[int]) -> int:
+        with self.write() as conn:
+            return conn.executemany(DELETE_HEARTBEAT_SQL, [(rig_id, ts) for ts in timestamps]).rowcount
+
+    def incremental_vacuum(self, pages: int) -> None:
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.execute(f"PRAGMA incremental_vacuum({pages})").fetchall()
+
+    def vacuum(self) -> None:
+        with self._write_lock:
+            self._writer.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._writer.execute("VACUUM")
+
+    def _metadata(self, conn: sqlite3.Connection, rig_id: str, digest: str) -> Dict[str, Any]:
+        static = self._metadata_cache.get((rig_id, digest))
+        if static is None:
+            row = conn.execute(SELECT_METADATA_SQL, (rig_id, digest)).fetchone()
+            static = self._metadata_cache[(rig_id, digest)] = json.loads(row[0]) if row else {}
+        return static
+
+    def expand_heartbeat(self, conn: sqlite3.Connection, row: sqlite3.Row) -> Dict[str, Any]:
+        # Merges a stored row back into the heartbeat the agent sent
+        stored = json.loads(row["data"] or "{}")
+        if row["metadata_hash"] is None:
+            return stored
+
+        data: Dict[str, Any] = {"rig_id": row["rig_id"], "timestamp": format_timestamp(row["ts"])}
+        data.update(self._metadata(conn, row["rig_id"], row["metadata_hash"]))
+        data.update(stored)
+        for metric in HOT_METRICS:
+            if row[metric] is not None:
+                data[metric] = row[metric]
+        return data
+
+    def current_metadata_hash(self, rig_id: str) -> Optional[str]:
+        # Taken from the latest heartbeat: a rig can go back to an older
+        # version, which keeps its original first_seen
+        with self.read() as conn:
+            row = conn.execute(SELECT_CURRENT_METADATA_SQL, (rig_id,)).fetchone()
+        return row[0] if row else None
+
+    def metadata_versions(self, rig_id: str) -> List[Dict[str, Any]]:
+        with self.read() as conn:
+            rows = conn.execute(SELECT_METADATA_VERSIONS_SQL, (rig_id,)).fetchall()
+        return [
+            {"hash": row["hash"], "first_seen": format_timestamp(row["first_seen"]), "metadata": json.loads(row["data"])}
+            for row in rows
+        ]
+
+    def record_events(self, events: List[Tuple[str, int, str, Optional[str], Optional[str], Any]]) -> None:
+        # events are (rig_id, ts, event, old_status, new_status, detail)
+        with self.write() as conn:
+            conn.executemany(INSERT_EVENT_SQL, [
+                (rig_id, ts, event, old_status, new_status,
+                 json.dumps(detail) if detail is not None else None)
+                for rig_id, ts, event, old_status, new_status, detail in events
+            ])
+            conn.executemany(UPDATE_RIG_STATUS_SQL, [
+                (new_status, rig_id)
+                for rig_id, _, _, old_status, new_status, _ in events
+                if new_status is not None and new_status != old_status
+            ])
+
+    def query_events(
+        self, rig_id: Optional[str], since: int, until: int, limit: int
+    ) -> List[Dict[str, Any]]:
+        sql = "SELECT * FROM rig_events WHERE ts >= ? AND ts < ?"
+        params: List[Any] = [since, until]
+        if rig_id is not None:
+            sql += " AND rig_id = ?"
+            params.append(rig_id)
+        sql += " ORDER BY ts DESC, id DESC LIMIT ?"
+        params.append(limit)
+
+        with self.read() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [
+            {
+                "id": row["id"],
+                "rig_id": row["rig_id"],
+                "timestamp": format_timestamp(row["ts"]),
+                "ts": row["ts"],
+                "event": row["event"],
+                "old_status": row["old_status"],
+                "new_status": row["new_status"],
+                "detail": json.loads(row["detail"]) if row["detail"] else None,
+            }
+            for row in rows
+        ]
+
+    def occupancy(self, rig_id: str, start: int, end: int) -> List[Dict[str, Any]]:
+        with self.read() as conn:
+            rows = conn.execute(
+                occupancy.SELECT_RIG_SQL, {"rig_id": rig_id, "start": start, "end": end}
+            ).fetchall()
+        return [
+            {
+                "start": format_timestamp(row["start_ts"]),
+                "end": format_timestamp(row["end_ts"]),
+                "start_ts": row["start_ts"],
+                "end_ts": row["end_ts"],
+                "busy": bool(row["busy"]),
+                "processes": json.loads(row["processes"]),
+            }
+            for row in rows
+        ]
+
+    def occupancy_totals(self, start: int, end: int) -> Dict[str, Dict[str, int]]:
+        # rig_id -> busy and idle milliseconds within [start, end)
+        totals: Dict[str, Dict[str, int]] = {}
+        with self.read() as conn:
+            for row in conn.execute(occupancy.SELECT_FLEET_SQL, {"start": start, "end": end}):
+                entry = totals.setdefault(row["rig_id"], {"busy_ms": 0, "idle_ms": 0, "busy_intervals": 0})
+                if row["busy"]:
+                    entry["busy_ms"] += row["ms"]
+                    entry["busy_intervals"] += row["intervals"]
+                else:
+                    entry["idle_ms"] += row["ms"]
+        return totals
+
+    def agent_configs(self) -> List[Tuple[str, int, Dict[str, Any]]]:
+        with self.read() as conn:
+            rows = conn.execute(SELECT_AGENT_CONFIGS_SQL).fetchall()
+        return [(row["scope"], row["version"], json.loads(row["data"])) for row in rows]
+
+    def save_agent_config(self, scope: str, doc: Dict[str, Any]) -> int:
+        with self.write() as conn:
+            conn.execute(UPSERT_AGENT_CONFIG_SQL, (scope, json.dumps(doc), now_ms()))
+            return conn.execute(SELECT_AGENT_CONFIG_VERSION_SQL, (scope,)).fetchone()[0]
+
+    def list_rigs(self) -> List[Dict[str, Any]]:
+        with self.read() as conn:
+            return [dict(row) for row in conn.execute(SELECT_RIGS_SQL)]
+
+    def latest_heartbeats(self) -> List[Dict[str, Any]]:
+        with self.read() as conn:
+            rows = conn.execute(SELECT_LATEST_HEARTBEATS_SQL).fetchall()
+            latest = {
+                row["rig_id"]: heartbeat_row(row["rig_id"], row["ts"], self.expand_heartbeat(conn, row))
+                for row in rows
+            }
+
+        # Rigs whose history has not been migrated to v2 yet
+        if self.has_table("heartbeats_v1"):
+            with self.read() as conn:
+                for rig in conn.execute(SELECT_RIGS_SQL).fetchall():
+                    if rig["rig_id"] in latest:
+                        continue
+                    row = conn.execute(SELECT_LEGACY_LATEST_HEARTBEAT_SQL, (rig["rig_id"],)).fetchone()
+                    heartbeat = parse_legacy_heartbeat(row["timestamp"], row["data"], None) if row else None
+                    if heartbeat:
+                        latest[row["rig_id"]] = heartbeat_row(row["rig_id"], heartbeat[0], heartbeat[1])
+        return list(latest.values())
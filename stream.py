@@ -0,0 +1,124 @@
+# stream.py
+
+import asyncio
+import json
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Set
+
+# Subscriber filters that are matched against the rig's latest heartbeat
+METADATA_FILTERS = ("location", "rack", "ecu_type")
+
+
+class SubscriberLimit(Exception):
+    pass
+
+
+class Subscriber:
+    def __init__(
+        self, loop: asyncio.AbstractEventLoop, filters: Dict[str, Set[str]], max_events: int
+    ) -> None:
+        self.loop = loop
+        self.filters = filters
+        self.max_events = max_events
+        self.dropped = False
+
+        self._lock = threading.Lock()
+        # Rig updates are coalesced per rig, so a slow reader only ever
+        # holds one pending update per rig
+        self._updates: Dict[str, Dict[str, Any]] = {}
+        self._events: Deque[Dict[str, Any]] = deque()
+        self._wakeup = asyncio.Event()
+
+    def matches(self, rig_id: str, attributes: Dict[str, Any]) -> bool:
+        rig_ids = self.filters.get("rig_id")
+        if rig_ids and rig_id not in rig_ids:
+            return False
+        for key in METADATA_FILTERS:
+            wanted = self.filters.get(key)
+            if wanted and attributes.get(key) not in wanted:
+                return False
+        wanted = self.filters.get("capability")
+        if wanted and not wanted.issubset(attributes.get("capabilities") or ()):
+            return False
+        return True
+
+    def _notify(self) -> None:
+        self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    def push_update(self, rig_id: str, update: Dict[str, Any]) -> None:
+        with self._lock:
+            pending = self._updates.get(rig_id)
+            if pending is None:
+                self._updates[rig_id] = {
+                    "rig_id": rig_id,
+                    "rig": update["rig"],
+                    "changes": dict(update["changes"]),
+                }
+            else:
+                pending["rig"] = update["rig"]
+                pending["changes"].update(update["changes"])
+        self._notify()
+
+    def push_event(self, event: Dict[str, Any]) -> None:
+        with self._lock:
+            if len(self._events) >= self.max_events:
+                # Events can't be coalesced; a reader this far behind has to
+                # reconnect and start again from a snapshot
+                self.dropped = True
+            else:
+                self._events.append(event)
+        self._notify()
+
+    async def wait(self, timeout: float) -> Optional[List[Dict[str, Any]]]:
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+        self._wakeup.clear()
+        with self._lock:
+            messages = list(self._events)
+            messages += ({"type": "rig", **update} for update in self._updates.values())
+            self._events.clear()
+            self._updates.clear()
+        return messages
+
+
+class Broker:
+    def __init__(self, max_subscribers: int = 100, max_events: int = 1000) -> None:
+        self.max_subscribers = max_subscribers
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._subscribers: List[Subscriber] = []
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self, filters: Dict[str, Set[str]]) -> Subscriber:
+        subscriber = Subscriber(asyncio.get_running_loop(), filters, self.max_events)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise SubscriberLimit("Too many stream subscribers")
+            # Copy on write so publishers can iterate without holding the lock
+            self._subscribers = self._subscribers + [subscriber]
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s is not subscriber]
+
+    def publish_update(self, update: Dict[str, Any], attributes: Dict[str, Any]) -> None:
+        rig_id = update["rig_id"]
+        for subscriber in self._subscribers:
+            if subscriber.matches(rig_id, attributes):
+                subscriber.push_update(rig_id, update)
+
+    def publish_event(self, event: Dict[str, Any], attributes: Dict[str, Any]) -> None:
+        for subscriber in self._subscribers:
+            if subscriber.matches(event["rig_id"], attributes):
+                subscriber.push_event(event)
+
+
+def format_event(event: str, data: Any) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
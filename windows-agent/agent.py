@@ -1,18 +1,52 @@
 # agent.py
 
+import gzip
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import psutil
 import socket
 import platform
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Iterator, List, Optional
+from contextlib import contextmanager
+import argparse
+import os
+import random
+import signal
 import sys
+import threading
+import time
+import zlib
 from logger import setup_logger
+from collectors import CollectorRegistry, Snapshot, register_custom
+from delta import DeltaEncoder
+from outbox import Backoff, Outbox
+from processes import ProcessTracker
+from sampler import Sampler
 
 VERSION = "0.1"
 CONFIG_PATH = Path(__file__).parent / "config.json"
+OUTBOX_PATH = Path(__file__).parent / "outbox.db"
+# Last config document received from the server
+REMOTE_CONFIG_PATH = Path(__file__).parent / "remote_config.json"
+
+DEFAULT_INTERVAL_S = 60
+DEFAULT_JITTER_S = 5
+DEFAULT_SAMPLE_RATE_HZ = 1.0
+DISK_PATH = "C:\\"
+DEFAULT_OUTBOX_MAX_MB = 50
+DEFAULT_OUTBOX_MAX_ITEMS = 100000
+REPLAY_BATCH_SIZE = 200
+DEFAULT_KEYFRAME_EVERY = 60
+# Hostname and IP rarely change, and name resolution can be slow
+NETWORK_INFO_INTERVAL_S = 300
+# Missed heartbeats before the watchdog gives up on a stuck loop
+WATCHDOG_INTERVALS = 5
+# The sampler keeps at least this much history, so a long server-set
+# interval is still summarized in full
+SAMPLER_WINDOW_S = 600
 
 logger = setup_logger()
 
@@ -20,51 +54,139 @@ logger = setup_logger()
 class Agent:
     def __init__(self, config_path: Path = CONFIG_PATH) -> None:
         self.config = self._load_config(config_path)
+        self.local_config = self.config
+        self.config_version: Optional[str] = None
         self.server_url: str = self.config["server_url"]
         self.api_key: str = self.config["api_key"]
         self.rig_id: str = self.config["rig_id"]
         self.metadata: Dict[str, Any] = self.config.get("metadata", {})
+        self.interval: float = self.config.get("interval_seconds", DEFAULT_INTERVAL_S)
+        self.jitter: float = self.config.get("jitter_seconds", DEFAULT_JITTER_S)
+
+        # One pooled keep-alive connection to the server, reused across runs
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.headers.update(
+            {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+            }
+        )
+
+        self.outbox = Outbox(
+            OUTBOX_PATH,
+            int(self.config.get("outbox_max_mb", DEFAULT_OUTBOX_MAX_MB) * 1024 * 1024),
+            self.config.get("outbox_max_items", DEFAULT_OUTBOX_MAX_ITEMS),
+        )
+        self.replay_backoff = Backoff()
+        self.delta_encoder: Optional[DeltaEncoder] = None
+        if self.config.get("delta_protocol", True):
+            self.delta_encoder = DeltaEncoder(
+                self.rig_id, self.config.get("keyframe_every", DEFAULT_KEYFRAME_EVERY)
+            )
+        self.sampler: Optional[Sampler] = None
+        self.process_tracker = ProcessTracker(self.config.get("process_names", []))
+
+        # Collectors run in parallel; one that misses its timeout is left out
+        # of the heartbeat instead of delaying it
+        self.collectors = CollectorRegistry()
+        self.collectors.register("processes", self._check_processes, timeout=10)
+        self.collectors.register("network", self._get_network_info, interval=NETWORK_INFO_INTERVAL_S, timeout=3)
+        self.collectors.register("system", self._collect_system_status, timeout=5)
+        register_custom(self.collectors, self.config.get("collectors", {}))
+        self._stage_timings: Dict[str, float] = {}
+        self._last_stage_timings: Dict[str, float] = {}
+        # Set from a 429/503: the server's suggested time for the next send
+        self.resume_at: Optional[float] = None
+        self._last_tick = time.monotonic()
+        self._stop = threading.Event()
+        self._load_remote_config()
 
     def _load_config(self, config_path: Path) -> Dict[str, Any]:
         logger.info(f"Loading configuration from {config_path}")
         with open(config_path, "r") as f:
             return json.load(f)
 
-    def _collect_system_status(self) -> Dict[str, Any]:
+    def _load_remote_config(self) -> None:
+        # Applied at startup so a restart doesn't fall back to config.json
+        # until the first heartbeat response arrives
+        try:
+            with open(REMOTE_CONFIG_PATH, "r") as f:
+                cached = json.load(f)
+            self.apply_config(cached["version"], cached["config"])
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Ignoring unreadable {REMOTE_CONFIG_PATH}: {e}")
+
+    def apply_config(self, version: str, remote: Dict[str, Any]) -> None:
+        # Remote settings win over config.json; a key dropped from the remote
+        # document falls back to the local value
+        self.config = {**self.local_config, **remote}
+        self.interval = self.config.get("interval_seconds", DEFAULT_INTERVAL_S)
+        self.jitter = self.config.get("jitter_seconds", DEFAULT_JITTER_S)
+        self.metadata = self.config.get("metadata", {})
+        self.process_tracker.set_names(self.config.get("process_names", []))
+        register_custom(self.collectors, self.config.get("collectors", {}))
+        self.config_version = version
+
+    def apply_directives(self, response: Dict[str, Any]) -> None:
+        config = response.get("config")
+        if isinstance(config, dict) and "config_version" in response:
+            logger.info(f"Applying config version {response['config_version']} from server")
+            self.apply_config(response["config_version"], config)
+            temp_path = REMOTE_CONFIG_PATH.with_suffix(".tmp")
+            with open(temp_path, "w") as f:
+                json.dump({"version": self.config_version, "config": config}, f, indent=2)
+            os.replace(temp_path, REMOTE_CONFIG_PATH)
+
+        # Adaptive interval for the next tick, on top of the configured one
+        interval = response.get("interval")
+        if isinstance(interval, (int, float)) and interval > 0 and interval != self.interval:
+            logger.info(f"Server set heartbeat interval to {interval}s")
+            self.interval = interval
+
+    def _collect_system_status(self, snapshot: Snapshot) -> Dict[str, Any]:
         logger.info("Collecting system status")
         boot_time = datetime.fromtimestamp(psutil.boot_time())
-        return {
-            "cpu_percent": psutil.cpu_percent(interval=1),
-            "memory_percent": psutil.virtual_memory().percent,
-            "memory_used_gb": round(psutil.virtual_memory().used / (1024**3), 2),
-            "memory_total_gb": round(psutil.virtual_memory().total / (1024**3), 2),
-            "disk_percent": psutil.disk_usage("C:\\").percent,
-            "disk_free_gb": round(psutil.disk_usage("C:\\").free / (1024**3), 2),
+        memory = snapshot.virtual_memory()
+        disk = snapshot.disk_usage(DISK_PATH)
+        status = {
+            "cpu_percent": None,
+            "memory_percent": memory.percent,
+            "memory_used_gb": round(memory.used / (1024**3), 2),
+            "memory_total_gb": round(memory.total / (1024**3), 2),
+            "disk_percent": disk.percent,
+            "disk_free_gb": round(disk.free / (1024**3), 2),
             "uptime_hours": round(
                 (datetime.now() - boot_time).total_seconds() / 3600, 1
             ),
         }
 
-    def _check_processes(self) -> Dict[str, str]:
-        result = {}
+        if self.sampler is None:
+            status["cpu_percent"] = psutil.cpu_percent(interval=1)
+        else:
+            # The daemon reports load over the whole interval, not a snapshot
+            stats = self.sampler.summary()
+            status["cpu_percent"] = stats["cpu_percent"]["avg"]
+            status["interval_stats"] = stats
+        return status
+
+    def _check_processes(self, snapshot: Snapshot) -> Dict[str, Any]:
         logger.info("Checking running processes")
-        config_process_names = self.config.get("process_names", [])
-        if not config_process_names:
+        if not self.process_tracker.names:
             logger.warning("Nothing configured to check")
             return {}
 
-        for process in psutil.process_iter(["name"]):
-            try:
-                process_name = process.info["name"]
-                if process_name in config_process_names:
-                    logger.info(f"{process_name} is running")
-                    result[process_name] = "running"
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                continue
-
+        scan = self.process_tracker.scan()
+        # Top-level "running" flags stay for servers that only know those
+        result: Dict[str, Any] = {process["name"]: "running" for process in scan["processes"]}
+        result["processes"] = scan["processes"]
+        result["process_events"] = scan["events"]
         return result
 
-    def _get_network_info(self) -> Dict[str, str]:
+    def _get_network_info(self, snapshot: Snapshot) -> Dict[str, str]:
         logger.info("Collecting network information")
         hostname = socket.gethostname()
         ip_address = socket.gethostbyname(hostname)
@@ -73,56 +195,259 @@ class Agent:
             "ip_address": ip_address,
         }
 
-    def collect_status(self) -> Dict[str, Any]:
-        running_processes = self._check_processes()
-        network_info = self._get_network_info()
-        system_status = self._collect_system_status()
+    @contextmanager
+    def _stage(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            self._stage_timings[name] = round(self._stage_timings.get(name, 0) + elapsed, 2)
 
+    def collect_status(self) -> Dict[str, Any]:
+        started = time.perf_counter()
+        collected = self.collectors.collect()
         status = {
             "rig_id": self.rig_id,
             "timestamp": datetime.now(timezone.utc).isoformat(),
-            **running_processes,
-            **network_info,
-            **system_status,
+            **collected,
             **self.metadata,
             "agent_version": VERSION,
+            "config_version": self.config_version,
             "os": platform.platform(),
+            # Sending happens after this heartbeat is built, so those stages
+            # are reported for the previous one
+            "timings": {
+                "collect_ms": round((time.perf_counter() - started) * 1000, 2),
+                "collectors_ms": self.collectors.timings,
+                "previous_send": self._last_stage_timings,
+            },
         }
 
         return status
 
-    def send_status(self, status: Dict[str, Any]):
-        logger.info(f"Sending rig status to server at {self.server_url}")
-        try:
-            response = requests.post(
-                f"{self.server_url}/api/heartbeat",
-                json=status,
-                headers={
-                    "Authorization": f"Bearer {self.api_key}",
-                    "Content-Type": "application/json",
-                },
+    def _send_delta(self, status: Dict[str, Any]) -> requests.Response:
+        with self._stage("serialize_ms"):
+            frame = self.delta_encoder.encode(status)
+            body = zlib.compress(json.dumps(frame, separators=(",", ":")).encode())
+        with self._stage("send_ms"):
+            response = self.session.post(
+                f"{self.server_url}/api/heartbeat/delta",
+                data=body,
+                headers={"Content-Encoding": "deflate"},
                 timeout=15,
             )
+        if response.status_code == 200:
+            self.delta_encoder.ack(frame, status)
+        elif response.status_code == 409 and frame["base"] is not None:
+            logger.info("Server asked for a keyframe")
+            self.delta_encoder.reset()
+            return self._send_delta(status)
+        return response
+
+    def _backoff_hint(self, response: requests.Response) -> Optional[float]:
+        # next_send_offset already includes a per-rig slot; Retry-After alone
+        # would bring every throttled rig back at the same moment
+        try:
+            offset = response.json().get("next_send_offset")
+            if isinstance(offset, (int, float)):
+                return float(offset)
+        except ValueError:
+            pass
+        try:
+            return float(response.headers["Retry-After"]) + random.uniform(0, self.jitter)
+        except (KeyError, ValueError):
+            return None
+
+    def send_status(self, status: Dict[str, Any]) -> Optional[requests.Response]:
+        logger.info(f"Sending rig status to server at {self.server_url}")
+        try:
+            response = None
+            if self.delta_encoder is not None:
+                response = self._send_delta(status)
+                if response.status_code == 404:
+                    logger.warning("Server does not accept delta heartbeats, sending full ones")
+                    self.delta_encoder = None
+                    response = None
 
-            if response.status_code != 200:
+            if response is None:
+                with self._stage("serialize_ms"):
+                    body = json.dumps(status).encode()
+                with self._stage("send_ms"):
+                    response = self.session.post(
+                        f"{self.server_url}/api/heartbeat", data=body, timeout=15
+                    )
+
+            if response.status_code in (429, 503):
+                delay = self._backoff_hint(response)
+                if delay is not None:
+                    logger.warning(f"Server is throttling heartbeats, next send in {delay:.0f}s")
+                    self.resume_at = time.monotonic() + delay
+            elif response.status_code != 200:
                 logger.error(
                     f"Server returned status {response.status_code}\n{response.text}"
                 )
+            return response
 
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to connect to server: {e}")
+            return None
+
+    def _send_batch(self, heartbeats: List[Dict[str, Any]]) -> Optional[requests.Response]:
+        body = gzip.compress(json.dumps(heartbeats, separators=(",", ":")).encode())
+        try:
+            return self.session.post(
+                f"{self.server_url}/api/heartbeats/batch",
+                data=body,
+                headers={"Content-Encoding": "gzip"},
+                timeout=30,
+            )
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to replay heartbeats: {e}")
+            return None
+
+    def replay_outbox(self, deadline: float) -> None:
+        # Runs only after the live heartbeat went through and stops at the
+        # deadline, so a backlog never delays the next live heartbeat
+        while len(self.outbox) and self.replay_backoff.ready() and time.monotonic() < deadline:
+            batch = self.outbox.peek(REPLAY_BATCH_SIZE)
+            response = self._send_batch([status for _, status in batch])
+            if response is None or response.status_code != 200:
+                if response is not None:
+                    logger.error(f"Server returned status {response.status_code} for replay")
+                delay = self.replay_backoff.failure()
+                if response is not None and response.status_code in (429, 503):
+                    hint = self._backoff_hint(response)
+                    if hint is not None:
+                        delay = self.replay_backoff.defer(hint)
+                logger.warning(f"Retrying outbox replay in {delay:.0f}s")
+                return
+
+            self.replay_backoff.success()
+            results = response.json()["results"]
+            for result in results:
+                if result["status"] == "rejected":
+                    logger.error(f"Server rejected spooled heartbeat: {result['error']}")
+            # Rejected heartbeats would be rejected again, so they go too
+            self.outbox.ack([batch[result["index"]][0] for result in results])
+            logger.info(f"Replayed {len(results)} heartbeats, {len(self.outbox)} left in outbox")
+
+    def report(self, status: Dict[str, Any]) -> None:
+        self._stage_timings = {}
+        try:
+            with self._stage("spool_ms"):
+                outbox_id = self.outbox.put(status)
+            response = self.send_status(status)
+        finally:
+            self._last_stage_timings = self._stage_timings
+        if response is None or response.status_code in (401, 429) or response.status_code >= 500:
+            return
+
+        # Anything else is final; a heartbeat the server refused once will
+        # never be accepted on replay
+        self.outbox.ack([outbox_id])
+        if response.status_code == 200:
+            try:
+                self.apply_directives(response.json())
+            except (ValueError, OSError) as e:
+                logger.error(f"Could not apply server config: {e}")
+            self.replay_outbox(time.monotonic() + self.interval / 2)
 
     def run(self) -> None:
         logger.info(f"Agent run at {datetime.now(timezone.utc).isoformat()}")
         status = self.collect_status()
         logger.info(f"Collected status: {json.dumps(status, indent=2)}")
-        self.send_status(status)
+        self.report(status)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _watchdog(self) -> None:
+        # A hung collector or socket would otherwise leave a live process that
+        # Task Scheduler considers healthy; exiting lets it start a fresh one
+        while not self._stop.wait(self.interval):
+            stalled = time.monotonic() - self._last_tick
+            if stalled > self.interval * WATCHDOG_INTERVALS:
+                logger.critical(f"Agent loop stalled for {stalled:.0f}s, exiting")
+                os._exit(3)
+
+    def _sampler_capacity(self, rate: float) -> int:
+        # Room for two intervals (or the minimum window), so a late heartbeat
+        # still sees every sample
+        return max(1, int(max(self.interval, SAMPLER_WINDOW_S) * rate * 2))
+
+    def run_daemon(self) -> None:
+        logger.info(f"Agent daemon started, interval {self.interval}s")
+        rate = self.config.get("sample_rate_hz", DEFAULT_SAMPLE_RATE_HZ)
+        self.sampler = Sampler(rate, self._sampler_capacity(rate), DISK_PATH)
+        self.sampler.start()
+        threading.Thread(target=self._watchdog, name="watchdog", daemon=True).start()
+
+        # Ticks are anchored to the start time rather than to the end of the
+        # previous run, so collection time never accumulates as drift. The
+        # first tick gets a random phase: Task Scheduler starts every rig on
+        # the same minute boundary, and so does a fleet-wide reboot.
+        next_tick = time.monotonic() + random.uniform(0, self.interval)
+        while True:
+            # Jitter shifts each run without moving the schedule, so a fleet
+            # started together spreads out but still averages one interval
+            delay = next_tick + random.uniform(0, self.jitter) - time.monotonic()
+            if self._stop.wait(max(0.0, delay)):
+                break
+            self._last_tick = time.monotonic()
+            try:
+                self.report(self.collect_status())
+            except Exception as e:
+                logger.exception(f"Agent run failed: {e}")
+            # The server or a config update may have lengthened the interval
+            self.sampler.resize(self._sampler_capacity(rate))
+
+            next_tick += self.interval
+            if self.resume_at is not None:
+                # Move the whole schedule to the slot the server suggested
+                next_tick = max(next_tick, self.resume_at)
+                self.resume_at = None
+            now = time.monotonic()
+            if next_tick < now:
+                skipped = int((now - next_tick) // self.interval) + 1
+                logger.warning(f"Agent run overran, skipping {skipped} interval(s)")
+                next_tick += skipped * self.interval
+
+        self.sampler.stop()
+        self.collectors.shutdown()
+        self.outbox.close()
+        self.session.close()
+        logger.info("Agent daemon stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vigilant Agent")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and send a heartbeat every interval",
+    )
+    args = parser.parse_args()
+
+    agent = Agent()
+    if not args.daemon:
+        agent.run()
+        return
+
+    def shutdown(signum, frame):
+        logger.info(f"Received signal {signum}, shutting down")
+        agent.stop()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    if hasattr(signal, "SIGBREAK"):
+        signal.signal(signal.SIGBREAK, shutdown)
+    agent.run_daemon()
 
 
 if __name__ == "__main__":
     try:
-        agent = Agent()
-        agent.run()
+        main()
     except Exception as e:
         logger.error(f"Fatal error: {e}")
         sys.exit(1)
@@ -0,0 +1,201 @@
+# collectors.py
+
+import socket
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from fnmatch import fnmatch
+from typing import Any, Callable, Dict, List, Optional
+
+import psutil
+from logger import setup_logger
+
+logger = setup_logger()
+
+
+class Snapshot:
+    # Memoizes psutil calls for one heartbeat, so collectors that need the
+    # same counters share a single call
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # One lock per key, so a slow disk doesn't hold up memory readers
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._values: Dict[str, Any] = {}
+
+    def get(self, key: str, func: Callable[[], Any]) -> Any:
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self._values:
+                self._values[key] = func()
+            return self._values[key]
+
+    def virtual_memory(self):
+        return self.get("virtual_memory", psutil.virtual_memory)
+
+    def disk_usage(self, path: str):
+        return self.get(f"disk_usage:{path}", lambda: psutil.disk_usage(path))
+
+
+CollectFunc = Callable[[Snapshot], Dict[str, Any]]
+
+
+class Collector:
+    def __init__(self, name: str, func: CollectFunc, interval: float = 0, timeout: float = 5) -> None:
+        # interval 0 runs the collector for every heartbeat; otherwise the
+        # last result is reused until it is due again
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout
+
+        self.result: Optional[Dict[str, Any]] = None
+        self.collected_at = 0.0
+        self.pending: Optional[Future] = None
+        self.duration_ms: Optional[float] = None
+
+    def run(self, snapshot: "Snapshot") -> Dict[str, Any]:
+        # Timed on the worker thread, so time spent queued for the pool
+        # doesn't count against the collector
+        started = time.perf_counter()
+        try:
+            return self.func(snapshot)
+        finally:
+            self.duration_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    def due(self, now: float) -> bool:
+        return self.result is None or now - self.collected_at >= self.interval
+
+
+class CollectorRegistry:
+    def __init__(self, max_workers: int = 4) -> None:
+        self.collectors: Dict[str, Collector] = {}
+        # Run time of each collector that ran in the last collect()
+        self.timings: Dict[str, Optional[float]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="collector")
+
+    def register(self, name: str, func: CollectFunc, interval: float = 0, timeout: float = 5) -> None:
+        self.collectors[name] = Collector(name, func, interval, timeout)
+
+    def unregister(self, name: str) -> None:
+        # A run still in flight finishes on its own and is discarded
+        self.collectors.pop(name, None)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    def collect(self) -> Dict[str, Any]:
+        snapshot = Snapshot()
+        start = time.monotonic()
+        status: Dict[str, Any] = {}
+        errors: Dict[str, str] = {}
+
+        running: List[Collector] = []
+        for collector in self.collectors.values():
+            if collector.pending is not None and not collector.pending.done():
+                # Still stuck in an earlier run; never queue a second copy
+                errors[collector.name] = "still running"
+            elif collector.due(start):
+                collector.pending = self._executor.submit(collector.run, snapshot)
+                running.append(collector)
+
+        for collector in running:
+            remaining = collector.timeout - (time.monotonic() - start)
+            try:
+                collector.result = collector.pending.result(timeout=max(0.0, remaining))
+                collector.collected_at = start
+            except FutureTimeout:
+                logger.warning(f"Collector {collector.name} missed its {collector.timeout}s deadline")
+                errors[collector.name] = "timeout"
+            except Exception as e:
+                logger.error(f"Collector {collector.name} failed: {e}")
+                errors[collector.name] = str(e)
+                collector.result = None
+
+        self.timings = {
+            collector.name: collector.duration_ms if collector.pending.done() else None
+            for collector in running
+        }
+        for collector in self.collectors.values():
+            if collector.name not in errors and collector.result is not None:
+                status.update(collector.result)
+        if errors:
+            status["collector_errors"] = errors
+        return status
+
+
+def extra_disks(options: Dict[str, Any]) -> CollectFunc:
+    paths = options.get("paths", [])
+
+    def collect(snapshot: Snapshot) -> Dict[str, Any]:
+        disks = {}
+        for path in paths:
+            usage = snapshot.disk_usage(path)
+            disks[path] = {
+                "percent": usage.percent,
+                "free_gb": round(usage.free / (1024**3), 2),
+            }
+        return {"disks": disks}
+
+    return collect
+
+
+def tcp_probe(options: Dict[str, Any]) -> CollectFunc:
+    # e.g. license servers: {"targets": [{"name": "flexlm", "host": "lic01", "port": 27000}]}
+    targets = options.get("targets", [])
+    connect_timeout = options.get("connect_timeout", 2)
+
+    def collect(snapshot: Snapshot) -> Dict[str, Any]:
+        results = {}
+        for target in targets:
+            name = target.get("name") or f"{target['host']}:{target['port']}"
+            started = time.perf_counter()
+            try:
+                with socket.create_connection((target["host"], target["port"]), connect_timeout):
+                    pass
+                results[name] = {"reachable": True, "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+            except OSError as e:
+                results[name] = {"reachable": False, "error": str(e)}
+        return {"tcp_probes": results}
+
+    return collect
+
+
+def can_interfaces(options: Dict[str, Any]) -> CollectFunc:
+    # Link state of CAN adapters that show up as network interfaces, matched
+    # by name pattern, e.g. {"patterns": ["PCAN*", "Vector*"]}
+    patterns = options.get("patterns", [])
+
+    def collect(snapshot: Snapshot) -> Dict[str, Any]:
+        stats = snapshot.get("net_if_stats", psutil.net_if_stats)
+        interfaces = {
+            name: {"up": stat.isup, "speed_mbps": stat.speed, "mtu": stat.mtu}
+            for name, stat in stats.items()
+            if any(fnmatch(name, pattern) for pattern in patterns)
+        }
+        return {"can_interfaces": interfaces}
+
+    return collect
+
+
+CUSTOM_COLLECTORS: Dict[str, Callable[[Dict[str, Any]], CollectFunc]] = {
+    "extra_disks": extra_disks,
+    "tcp_probe": tcp_probe,
+    "can_interfaces": can_interfaces,
+}
+
+
+def register_custom(registry: CollectorRegistry, config: Dict[str, Dict[str, Any]]) -> None:
+    # Replaces whatever was registered before, so it can be re-run when the
+    # server sends a new config
+    for name in CUSTOM_COLLECTORS:
+        registry.unregister(name)
+    for name, options in config.items():
+        if not options.get("enabled", True):
+            continue
+        factory = CUSTOM_COLLECTORS.get(name)
+        if factory is None:
+            logger.warning(f"Unknown collector in config: {name}")
+            continue
+        registry.register(name, factory(options), options.get("interval", 0), options.get("timeout", 5))
@@ -0,0 +1,38 @@
+# delta.py
+
+from typing import Any, Dict, Optional
+
+
+class DeltaEncoder:
+    # Encodes heartbeats as changes against the last state the server
+    # acknowledged, with a full keyframe every keyframe_every heartbeats
+    def __init__(self, rig_id: str, keyframe_every: int = 60) -> None:
+        self.rig_id = rig_id
+        self.keyframe_every = keyframe_every
+        self.seq = 0
+        self._acked_seq: Optional[int] = None
+        self._acked_state: Optional[Dict[str, Any]] = None
+        self._since_keyframe = 0
+
+    def encode(self, status: Dict[str, Any]) -> Dict[str, Any]:
+        self.seq += 1
+        acked = self._acked_state
+        if acked is None or self._since_keyframe >= self.keyframe_every:
+            return {"rig_id": self.rig_id, "seq": self.seq, "base": None, "set": status}
+
+        return {
+            "rig_id": self.rig_id,
+            "seq": self.seq,
+            "base": self._acked_seq,
+            "set": {key: value for key, value in status.items() if key not in acked or acked[key] != value},
+            "unset": [key for key in acked if key not in status],
+        }
+
+    def ack(self, frame: Dict[str, Any], status: Dict[str, Any]) -> None:
+        self._acked_seq = frame["seq"]
+        self._acked_state = status
+        self._since_keyframe = 0 if frame["base"] is None else self._since_keyframe + 1
+
+    def reset(self) -> None:
+        # The next frame will be a keyframe
+        self._acked_state = None
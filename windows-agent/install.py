@@ -146,6 +146,7 @@ class Installer:
         logger.info("")
         logger.info("Useful Commands:")
         logger.info("Manual test:   python agent.py")
+        logger.info("Run daemon:    python agent.py --daemon")
         logger.info("Check task:    schtasks /Query /TN VigilantAgent /FO LIST")
         logger.info("Uninstall:     python uninstall.py")
         logger.info("=" * 60)
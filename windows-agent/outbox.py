@@ -0,0 +1,135 @@
+# outbox.py
+
+import json
+import random
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from logger import setup_logger
+
+logger = setup_logger()
+
+CREATE_SQL = """
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at REAL NOT NULL,
+        payload BLOB NOT NULL
+    )
+"""
+INSERT_SQL = "INSERT INTO outbox (created_at, payload) VALUES (?, ?)"
+SELECT_SQL = "SELECT id, payload FROM outbox ORDER BY id LIMIT ?"
+STATS_SQL = "SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM outbox"
+OLDEST_SQL = "SELECT id, LENGTH(payload) FROM outbox ORDER BY id LIMIT ?"
+
+
+class Outbox:
+    # Heartbeats are spooled here before sending and only deleted once the
+    # server has acknowledged them
+    def __init__(self, path: Path, max_bytes: int, max_items: int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute(CREATE_SQL)
+        self._count, self._bytes = self._conn.execute(STATS_SQL).fetchone()
+        if self._count:
+            logger.info(f"Outbox holds {self._count} unsent heartbeats")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def put(self, status: Dict[str, Any]) -> int:
+        payload = json.dumps(status, separators=(",", ":")).encode()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                outbox_id = self._conn.execute(INSERT_SQL, (time.time(), payload)).lastrowid
+                self._count += 1
+                self._bytes += len(payload)
+                self._evict()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                self._count, self._bytes = self._conn.execute(STATS_SQL).fetchone()
+                raise
+        return outbox_id
+
+    def _evict(self) -> None:
+        # Oldest first, so a long outage keeps the most recent history
+        excess = self._count - self.max_items
+        evicted = 0
+        while excess > 0 or self._bytes > self.max_bytes:
+            rows = self._conn.execute(OLDEST_SQL, (max(excess, 100),)).fetchall()
+            if not rows:
+                break
+            for outbox_id, size in rows:
+                if excess <= 0 and self._bytes <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+                self._count -= 1
+                self._bytes -= size
+                excess -= 1
+                evicted += 1
+        if evicted:
+            logger.warning(f"Outbox full, dropped {evicted} oldest heartbeats")
+
+    def peek(self, limit: int) -> List[Tuple[int, Dict[str, Any]]]:
+        with self._lock:
+            rows = self._conn.execute(SELECT_SQL, (limit,)).fetchall()
+        return [(outbox_id, json.loads(payload)) for outbox_id, payload in rows]
+
+    def ack(self, ids: List[int]) -> None:
+        if not ids:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ", ".join("?" for _ in chunk)
+                count, size = self._conn.execute(
+                    f"SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM outbox WHERE id IN ({placeholders})",
+                    chunk,
+                ).fetchone()
+                self._conn.execute(f"DELETE FROM outbox WHERE id IN ({placeholders})", chunk)
+                self._count -= count
+                self._bytes -= size
+            self._conn.execute("COMMIT")
+
+
+class Backoff:
+    def __init__(self, base: float = 5, maximum: float = 600) -> None:
+        self.base = base
+        self.maximum = maximum
+        self.failures = 0
+        self.ready_at = 0.0
+
+    def ready(self) -> bool:
+        return time.monotonic() >= self.ready_at
+
+    def success(self) -> None:
+        self.failures = 0
+        self.ready_at = 0.0
+
+    def failure(self) -> float:
+        # Full jitter, so rigs that lost the server together don't all
+        # come back at the same moment
+        self.failures += 1
+        delay = random.uniform(0, min(self.maximum, self.base * 2 ** self.failures))
+        self.ready_at = time.monotonic() + delay
+        return delay
+
+    def defer(self, delay: float) -> float:
+        # The server said when to come back; never earlier than that
+        self.ready_at = max(self.ready_at, time.monotonic() + delay)
+        return self.ready_at - time.monotonic()
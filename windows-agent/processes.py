@@ -0,0 +1,115 @@
+# processes.py
+
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Set
+
+import psutil
+from logger import setup_logger
+
+logger = setup_logger()
+
+# Forget which PIDs were uninteresting every so often, in case one was reused
+# by a watched process between two scans
+FULL_RESCAN_EVERY = 10
+
+
+def _isoformat(epoch_s: float) -> str:
+    return datetime.fromtimestamp(epoch_s, timezone.utc).isoformat()
+
+
+class ProcessTracker:
+    def __init__(self, names: List[str]) -> None:
+        self.names = set(names)
+        # Handles are kept between scans so per-process CPU is measured over
+        # the whole interval and new PIDs are the only ones looked up
+        self._tracked: Dict[int, psutil.Process] = {}
+        self._ignored: Set[int] = set()
+        self._scans = 0
+        self._names_changed = False
+
+    def set_names(self, names: List[str]) -> None:
+        # Takes effect at the next scan, which may already be running on a
+        # collector thread
+        if set(names) != self.names:
+            self.names = set(names)
+            self._names_changed = True
+
+    def _stopped(self, pid: int, events: List[Dict[str, Any]]) -> None:
+        process = self._tracked.pop(pid)
+        name = process.info["name"]
+        logger.info(f"{name} (pid {pid}) stopped")
+        events.append(
+            {
+                "event": "stopped",
+                "name": name,
+                "pid": pid,
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+            }
+        )
+
+    def scan(self) -> Dict[str, Any]:
+        events: List[Dict[str, Any]] = []
+        first_scan = self._scans == 0
+        self._scans += 1
+        if self._scans % FULL_RESCAN_EVERY == 0 or self._names_changed:
+            self._ignored.clear()
+        if self._names_changed:
+            self._names_changed = False
+            # No longer watched; dropped quietly rather than reported as stopped
+            for pid in [pid for pid, process in self._tracked.items() if process.info["name"] not in self.names]:
+                del self._tracked[pid]
+
+        pids = set(psutil.pids())
+        for pid in list(self._tracked):
+            if pid not in pids or not self._tracked[pid].is_running():
+                self._stopped(pid, events)
+        self._ignored &= pids
+
+        for pid in pids - self._ignored - self._tracked.keys():
+            try:
+                process = psutil.Process(pid)
+                name = process.name()
+                if name not in self.names:
+                    self._ignored.add(pid)
+                    continue
+                process.info = {"name": name, "create_time": process.create_time()}
+                process.cpu_percent(interval=None)
+            except psutil.AccessDenied:
+                self._ignored.add(pid)
+                continue
+            except psutil.NoSuchProcess:
+                continue
+
+            self._tracked[pid] = process
+            logger.info(f"{name} (pid {pid}) is running")
+            # Processes already running when the agent starts are not news
+            if not first_scan:
+                events.append(
+                    {
+                        "event": "started",
+                        "name": name,
+                        "pid": pid,
+                        "timestamp": _isoformat(process.info["create_time"]),
+                    }
+                )
+
+        processes = []
+        for pid, process in sorted(self._tracked.items()):
+            try:
+                with process.oneshot():
+                    processes.append(
+                        {
+                            "name": process.info["name"],
+                            "pid": pid,
+                            "cpu_percent": process.cpu_percent(interval=None),
+                            "rss_mb": round(process.memory_info().rss / (1024**2), 1),
+                            "started": _isoformat(process.info["create_time"]),
+                            "handles": process.num_handles() if hasattr(process, "num_handles") else None,
+                        }
+                    )
+            except psutil.NoSuchProcess:
+                self._stopped(pid, events)
+            except psutil.AccessDenied:
+                continue
+
+        return {"processes": processes, "events": events}
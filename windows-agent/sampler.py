@@ -0,0 +1,103 @@
+# sampler.py
+
+import math
+import threading
+import time
+from array import array
+from typing import Dict, Optional
+
+import psutil
+from logger import setup_logger
+
+logger = setup_logger()
+
+METRICS = ("cpu_percent", "memory_percent", "disk_percent")
+
+
+class Sampler:
+    def __init__(self, rate_hz: float = 1.0, capacity: int = 600, disk_path: str = "C:\\") -> None:
+        self.period = 1.0 / rate_hz
+        self.capacity = capacity
+        self.disk_path = disk_path
+
+        self._lock = threading.Lock()
+        # One fixed ring per metric; _written counts every sample ever taken
+        # and _drained marks where the last summary stopped
+        self._rings = {metric: array("d", bytes(8 * capacity)) for metric in METRICS}
+        self._written = 0
+        self._drained = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        # The first non-blocking cpu_percent call only sets the baseline
+        psutil.cpu_percent(interval=None)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _sample(self) -> None:
+        values = (
+            psutil.cpu_percent(interval=None),
+            psutil.virtual_memory().percent,
+            psutil.disk_usage(self.disk_path).percent,
+        )
+        with self._lock:
+            slot = self._written % self.capacity
+            for metric, value in zip(METRICS, values):
+                self._rings[metric][slot] = value
+            self._written += 1
+
+    def resize(self, capacity: int) -> None:
+        # Only grows; every sample still held keeps its place in the sequence
+        with self._lock:
+            if capacity <= self.capacity:
+                return
+            rings = {metric: array("d", bytes(8 * capacity)) for metric in METRICS}
+            for i in range(max(0, self._written - self.capacity), self._written):
+                for metric in METRICS:
+                    rings[metric][i % capacity] = self._rings[metric][i % self.capacity]
+            self._rings = rings
+            # Samples the old ring had already overwritten are gone for good
+            self._drained = max(self._drained, self._written - self.capacity)
+            self.capacity = capacity
+
+    def _run(self) -> None:
+        next_sample = time.monotonic() + self.period
+        while not self._stop.wait(max(0.0, next_sample - time.monotonic())):
+            try:
+                self._sample()
+            except Exception as e:
+                logger.error(f"Sampling failed: {e}")
+            next_sample += self.period
+            if next_sample < time.monotonic():
+                next_sample = time.monotonic() + self.period
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        # Aggregates everything sampled since the previous call
+        if self._written == self._drained:
+            self._sample()
+        with self._lock:
+            start = max(self._drained, self._written - self.capacity)
+            slots = [i % self.capacity for i in range(start, self._written)]
+            samples = {metric: [self._rings[metric][slot] for slot in slots] for metric in METRICS}
+            self._drained = self._written
+
+        result = {}
+        for metric, values in samples.items():
+            if not values:
+                continue
+            ordered = sorted(values)
+            result[metric] = {
+                "min": round(ordered[0], 1),
+                "avg": round(sum(ordered) / len(ordered), 1),
+                "p95": round(ordered[math.ceil(0.95 * len(ordered)) - 1], 1),
+                "max": round(ordered[-1], 1),
+                "samples": len(ordered),
+            }
+        return result